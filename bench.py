@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012-2016 SEOmoz, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Benchmarks for url on generated corpora, with results written as JSON so that they
+can be compared across commits:
+
+    python bench.py -o before.json
+    # ... change things ...
+    python bench.py -o after.json --compare before.json
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import pkgutil
+import random
+import re
+import subprocess
+import sys
+import time
+
+import url
+
+# The most precise clock available, which Python 2 lacks
+clock = getattr(time, 'perf_counter', time.time)
+
+
+###############################################################################
+# Corpora
+###############################################################################
+
+TLDS = ['com', 'org', 'net', 'de', 'co.uk', 'com.au', 'io', 'jp', 'blogspot.com']
+WORDS = [
+    'news', 'blog', 'shop', 'about', 'products', 'index', 'search', 'article', 'user',
+    'images', '2016', 'category', 'tag', 'page', 'static', 'en', 'wiki', 'item']
+IDN_LABELS = [
+    u'münchen', u'bücher', u'例え', u'пример', u'δοκιμή', u'café', u'españa', u'日本語']
+PARAMS = [
+    'utm_source', 'utm_medium', 'utm_campaign', 'sessionid', 'id', 'page', 'q', 'sort',
+    'ref', 'lang', 'fbclid', 'gclid']
+JUNK = [
+    'http://foo.com:80x/', 'http://foo.com:99999/', 'javascript:void(0)', '', '   ',
+    'mailto:', 'http://', '::::', 'http://[::1', '%%%', 'http://user@:80/']
+
+
+def host(rng, idn=False):
+    '''Return a random hostname, with IDN labels if idn.'''
+    labels = [rng.choice(IDN_LABELS) if idn else rng.choice(WORDS)]
+    if rng.random() < 0.6:
+        labels.insert(0, rng.choice(['www', 'm', 'blog', 'shop', 'www2']))
+    return '.'.join(labels + [rng.choice(TLDS)])
+
+
+def path(rng, depth):
+    '''Return a random absolute path of depth segments, some of them . and ..'''
+    segments = []
+    for _ in range(depth):
+        roll = rng.random()
+        if roll < 0.05:
+            segments.append('..')
+        elif roll < 0.1:
+            segments.append('.')
+        elif roll < 0.15:
+            segments.append(rng.choice(WORDS) + ' ' + rng.choice(WORDS))
+        else:
+            segments.append(rng.choice(WORDS))
+    return '/' + '/'.join(segments)
+
+
+def query(rng, count):
+    '''Return a random query string of count parameters.'''
+    return '&'.join(
+        '%s=%s' % (rng.choice(PARAMS), rng.randint(0, 10 ** rng.randint(1, 12)))
+        for _ in range(count))
+
+
+def typical(rng):
+    result = 'http%s://%s%s' % (
+        rng.choice(['', 's']), host(rng), path(rng, rng.randint(0, 5)))
+    if rng.random() < 0.4:
+        result += '?' + query(rng, rng.randint(1, 4))
+    if rng.random() < 0.1:
+        result += '#' + rng.choice(WORDS)
+    return result
+
+
+def idn(rng):
+    return 'http://%s%s' % (host(rng, idn=True), path(rng, rng.randint(0, 3)))
+
+
+def long_query(rng):
+    return 'http://%s/search?%s' % (host(rng), query(rng, rng.randint(20, 60)))
+
+
+def relative(rng):
+    '''Return a relative href, many of them deep and with ../'s.'''
+    return ('../' * rng.randint(0, 6)) + path(rng, rng.randint(1, 12))[1:]
+
+
+def junk(rng):
+    '''Return input like crawls are full of, a third of which can't be parsed.'''
+    if rng.random() < 0.33:
+        return rng.choice(JUNK)
+    return rng.choice(['http://', 'HTTP://', '//', ' http://', '']) + (
+        host(rng) + ':' + rng.choice(['80', '443', '', '8080']) +
+        path(rng, rng.randint(0, 4)) + rng.choice(['', '?', '?&&', ';p', '#']))
+
+
+GENERATORS = {
+    'typical': typical,
+    'idn': idn,
+    'long_query': long_query,
+    'relative': relative,
+    'junk': junk,
+}
+
+
+def corpus(kind, size, seed=0):
+    '''Return a deterministic list of size url strings of the given kind.'''
+    rng = random.Random('%s-%s' % (kind, seed))
+    return [GENERATORS[kind](rng).encode('utf-8') for _ in range(size)]
+
+
+###############################################################################
+# Benchmarks
+###############################################################################
+
+def has(*names):
+    '''Return whether url has all of names, so that older versions can be measured.'''
+    return all(hasattr(url, name) for name in names)
+
+
+def hashable(item):
+    try:
+        hash(item)
+    except TypeError:
+        return False
+    return True
+
+
+def parsed(strings):
+    '''Return the URLs of those strings that can be parsed.'''
+    if has('try_parse_many'):
+        return [u for u in url.try_parse_many(strings)[0] if u is not None]
+    result = []
+    for string in strings:
+        try:
+            result.append(url.parse(string))
+        except ValueError:
+            pass
+    return result
+
+
+def fresh(function):
+    '''
+    Mark function as needing fresh copies of its URLs for every run, because it
+    modifies them or they cache what it computes. The copies aren't timed.
+    '''
+    function.fresh = True
+    return function
+
+
+def each(method, *args):
+    '''Return a function running method on each of its URLs, which it modifies.'''
+    return fresh(lambda items: [getattr(u, method)(*args) for u in items])
+
+
+def benchmarks(size):
+    '''
+    Yield (name, items, function) for each benchmark that this version of url
+    supports, where function does something to each of the items.
+    '''
+    strings = dict((kind, corpus(kind, size)) for kind in GENERATORS)
+    typical_urls = parsed(strings['typical'])
+    idn_urls = parsed(strings['idn'])
+    long_urls = parsed(strings['long_query'])
+    junk_strings = strings['junk']
+    hrefs = [h.decode('utf-8') for h in strings['relative']]
+    base = url.parse(b'http://www.example.com/a/b/c/d/e/f/g/h/i/j/k/l/index.html')
+
+    for kind in ('typical', 'idn', 'long_query'):
+        yield 'parse.' + kind, strings[kind], lambda items: [url.parse(s) for s in items]
+        if has('parse_many'):
+            yield 'parse_many.' + kind, strings[kind], lambda items: url.parse_many(items)
+    if has('try_parse_many'):
+        yield 'try_parse_many.junk', junk_strings, url.try_parse_many
+
+    yield 'copy', typical_urls, lambda items: [u.copy() for u in items]
+    for method in ('strip', 'abspath', 'escape', 'unescape', 'canonical', 'defrag',
+                   'deuserinfo', 'remove_default_port', 'sanitize'):
+        yield method, typical_urls, each(method)
+    yield 'deparam.list', long_urls, each('deparam', PARAMS[:6])
+    if has('ParamSet'):
+        yield 'deparam.param_set', long_urls, each('deparam', url.ParamSet(PARAMS[:6]))
+    yield 'canonical.long_query', long_urls, each('canonical')
+    yield 'punycode', idn_urls, each('punycode')
+    punycoded = [u.copy().punycode() for u in idn_urls]
+    yield 'unpunycode', punycoded, each('unpunycode')
+    yield 'relative', hrefs, lambda items: [base.relative(h) for h in items]
+    if has('Resolver'):
+        yield 'resolve_many', hrefs, url.Resolver(base.utf8).resolve_many
+
+    # Fresh copies, so that nothing is cached by URL objects
+    yield 'utf8', typical_urls, fresh(lambda items: [u.utf8 for u in items])
+    yield 'unicode', typical_urls, fresh(lambda items: [u.unicode for u in items])
+    if hashable(base):
+        yield 'hash', typical_urls, fresh(lambda items: [hash(u) for u in items])
+    if hasattr(base, 'fingerprint'):
+        yield 'fingerprint', typical_urls, fresh(
+            lambda items: [u.fingerprint() for u in items])
+    if has('fingerprint_many'):
+        yield 'fingerprint_many', strings['typical'], url.fingerprint_many
+    pairs = list(zip(typical_urls, reversed(typical_urls)))
+    yield 'equiv', pairs, lambda items: [a.equiv(b) for a, b in items]
+    if has('surt_many'):
+        yield 'surt_many', strings['typical'], url.surt_many
+
+    yield 'pld', typical_urls, fresh(lambda items: [u.pld for u in items])
+    yield 'tld', typical_urls, fresh(lambda items: [u.tld for u in items])
+    if has('pld_many', 'tld_many'):
+        yield 'pld_many', strings['typical'], url.pld_many
+        yield 'tld_many', strings['typical'], url.tld_many
+
+    # run restores the default PSL afterwards with get_psl
+    if has('get_psl', 'compile_psl'):
+        rules = pkgutil.get_data('url', 'psl/2016-08-16.psl')
+        compiled = url.compile_psl(rules)
+        set_each = lambda items: [url.set_psl(item) for item in items]
+        yield 'set_psl.text', [rules], set_each
+        yield 'set_psl.compiled', [compiled], set_each
+        if has('PSL'):
+            yield 'set_psl.object', [url.PSL(compiled)], set_each
+
+    if has('Pipeline'):
+        pipeline = url.Pipeline(['strip', 'abspath', 'escape', 'canonical', 'defrag'])
+        yield 'pipeline', strings['typical'], pipeline.apply
+    if has('dumps_many', 'loads_many'):
+        yield 'dumps_many', typical_urls, url.dumps_many
+        dumped = url.dumps_many(typical_urls)
+        yield 'loads_many', typical_urls, lambda items: url.loads_many(dumped)
+
+
+def timed(function, items, runs):
+    '''Return the time in seconds to run function on items, runs times.'''
+    if not getattr(function, 'fresh', False):
+        start = clock()
+        for _ in range(runs):
+            function(items)
+        return clock() - start
+
+    elapsed = 0
+    for _ in range(runs):
+        copies = [u.copy() for u in items]
+        start = clock()
+        function(copies)
+        elapsed += clock() - start
+    return elapsed
+
+
+def measure(function, items, repeat, minimum=0.1):
+    '''Return the fastest time in ns per item to run function on items.'''
+    runs = 1
+    while True:
+        elapsed = timed(function, items, runs)
+        if elapsed >= minimum:
+            break
+        runs *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        best = min(best, timed(function, items, runs))
+    return best / runs / len(items) * 1e9
+
+
+def import_time(repeat):
+    '''Return the fastest time in ns to import url in a new interpreter.'''
+    script = (
+        'import time; clock = getattr(time, "perf_counter", time.time); '
+        'start = clock(); import url; print((clock() - start) * 1e9)')
+    return min(
+        float(subprocess.check_output([sys.executable, '-c', script]))
+        for _ in range(repeat))
+
+
+def commit():
+    '''Return the current git commit, if there is one.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size, repeat, pattern):
+    '''Return the results of the benchmarks with names matching pattern.'''
+    results = {}
+    if re.search(pattern, 'import'):
+        results['import'] = {'ns_per_item': import_time(repeat), 'items': 1}
+    original = url.get_psl() if has('get_psl') else None
+    try:
+        for name, items, function in benchmarks(size):
+            if re.search(pattern, name):
+                results[name] = {
+                    'ns_per_item': measure(function, items, repeat),
+                    'items': len(items)
+                }
+    finally:
+        if original is not None:
+            url.set_psl(original)
+    return {
+        'meta': {
+            'commit': commit(),
+            'build': getattr(url, 'BUILD', None),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'size': size,
+            'repeat': repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'results': results
+    }
+
+
+def compare(baseline, current, threshold):
+    '''Print how current compares to baseline, returning the names that regressed.'''
+    regressed = []
+    print('%-24s %12s %12s %8s' % ('benchmark', 'baseline ns', 'current ns', 'ratio'))
+    for name in sorted(current['results']):
+        now = current['results'][name]['ns_per_item']
+        if name not in baseline['results']:
+            print('%-24s %12s %12.1f' % (name, '-', now))
+            continue
+        then = baseline['results'][name]['ns_per_item']
+        ratio = now / then
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = ' slower'
+            regressed.append(name)
+        elif ratio < 1 - threshold:
+            flag = ' faster'
+        print('%-24s %12.1f %12.1f %8.2f%s' % (name, then, now, ratio, flag))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-o', '--output', help='Where to write the results as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+        help='Results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='How much slower than the baseline counts as a regression '
+             '(default: %(default)s)')
+    parser.add_argument('--size', type=int, default=2000,
+        help='Number of urls in each corpus (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='Number of times to time each benchmark (default: %(default)s)')
+    parser.add_argument('-k', '--filter', default='',
+        help='Only run benchmarks whose names match this regular expression')
+    args = parser.parse_args(argv)
+
+    results = run(args.size, args.repeat, args.filter)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fin:
+            baseline = json.load(fin)
+        regressed = compare(baseline, results, args.threshold)
+        if regressed:
+            print('Regressed by more than %d%%: %s' % (
+                100 * args.threshold, ', '.join(regressed)))
+            return 1
+    elif not args.output:
+        for name in sorted(results['results']):
+            print('%-24s %12.1f ns' % (name, results['results'][name]['ns_per_item']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
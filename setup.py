@@ -24,6 +24,9 @@
 from setuptools import setup
 from setuptools.extension import Extension
 
+import os
+import sys
+
 ext_files = [
     'url/url-cpp/src/url.cpp',
     'url/url-cpp/src/utf8.cpp',
@@ -32,22 +35,38 @@ ext_files = [
     'url/url.pyx'
 ]
 
-import sys
-
 extra_args = []
 if(sys.platform == 'win32'):
     extra_args.append('/std:c++14')
 else:
     extra_args.append('-std=c++11')
 
+# Set URL_PROFILE=1 to build with Cython line tracing, for profiling and coverage.
+# This is much slower, and requires Cython.
+profile = os.environ.get('URL_PROFILE', '0') not in ('', '0')
+
+define_macros = []
+if profile:
+    define_macros.append(('CYTHON_TRACE', '1'))
+    define_macros.append(('CYTHON_TRACE_NOGIL', '1'))
+
 ext_modules = [
     Extension(
         'url.url', ext_files,
         language='c++',
         extra_compile_args=extra_args,
-        include_dirs=['url/url-cpp/include'])
+        define_macros=define_macros,
+        include_dirs=['url', 'url/url-cpp/include'])
 ]
 
+if profile:
+    from Cython.Build import cythonize
+    # Keep the traced sources out of the tree, so that url/url.cpp stays a release build
+    ext_modules = cythonize(
+        ext_modules,
+        build_dir='build/profile',
+        compiler_directives={'linetrace': True})
+
 setup(
     ext_modules=ext_modules,
     packages=[ 'url' ],
@@ -29,8 +29,28 @@ if text_type == str:
 else:
     from .url import StringURL as URL
 
-from .url import set_psl
+from .url import (
+    PSL, set_psl, get_psl, compile_psl, set_psl_cache_size, psl_cache_info,
+    set_intern_pool_size, intern_pool_info, pld_many, tld_many, fingerprint_many,
+    surt_many, ParamFilter, ParamSet, Pipeline, Resolver, RuleSet, SeenSet, URLArray,
+    dumps, loads, dumps_many, loads_many, PARSE_OK, PARSE_INVALID_PORT,
+    PARSE_PORT_OUT_OF_RANGE, PARSE_INVALID_ENCODING, BUILD, stats)
 
 def parse(url, encoding='utf-8'):
     '''Parse the provided url string and return an URL object'''
     return URL.parse(url, encoding)
+
+def parse_many(urls, encoding='utf-8'):
+    '''Parse each of the provided url strings and return a list of URL objects'''
+    return URL.parse_many(urls, encoding)
+
+def try_parse(url, encoding='utf-8'):
+    '''Parse the provided url string and return an URL object, or None if it's invalid'''
+    return URL.try_parse(url, encoding)
+
+def try_parse_many(urls, encoding='utf-8'):
+    '''
+    Parse each of the provided url strings and return a list of URL objects (or None
+    for the invalid ones) and an array('B') of the reason for each
+    '''
+    return URL.try_parse_many(urls, encoding)
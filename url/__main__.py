@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012-2016 SEOmoz, Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Normalize newline-delimited urls from files or stdin:
+
+    python -m url --defrag --deparam utm_source,utm_medium --abspath --pld urls.gz
+'''
+
+import argparse
+import collections
+import gzip
+import itertools
+import multiprocessing
+import sys
+
+from . import PSL, ParamSet, Pipeline, set_psl, pld_many, tld_many
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Set in each worker by initialize
+pipeline = None
+columns = []
+
+
+def initialize(steps, pld=False, tld=False, psl=None):
+    '''Prepare this process to run process on chunks.'''
+    global pipeline, columns
+    if psl is not None:
+        set_psl(PSL.from_file(psl))
+    pipeline = Pipeline(compile_steps(steps))
+    columns = []
+    if pld:
+        columns.append(pld_many)
+    if tld:
+        columns.append(tld_many)
+
+
+def compile_steps(steps):
+    '''Return steps with the parameters to deparam as ParamSets.'''
+    return [
+        ('deparam', ParamSet(step[1])) if isinstance(step, tuple) and step[0] == 'deparam'
+        else step
+        for step in steps]
+
+
+def rows(lines):
+    '''Return the output rows for lines, raising ValueError if any are rejected.'''
+    results = pipeline.apply(lines)
+    if not columns:
+        return results
+    return [b'\t'.join(row) for row in zip(results, *[c(results) for c in columns])]
+
+
+def process(lines):
+    '''Return the output rows and the rejected lines for a chunk of lines.'''
+    try:
+        return rows(lines), []
+    except ValueError:
+        pass
+
+    # Something in this chunk is bad, so find out which lines are to blame
+    output, rejects = [], []
+    for line in lines:
+        try:
+            output.extend(rows([line]))
+        except ValueError:
+            rejects.append(line)
+    return output, rejects
+
+
+def open_input(path):
+    '''Open path ('-' for stdin) for reading, decompressing it if it's gzipped.'''
+    if path == '-':
+        stream = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        stream = open(path, 'rb')
+    if hasattr(stream, 'peek'):
+        gzipped = stream.peek(2)[:2] == GZIP_MAGIC
+    else:
+        gzipped = path.endswith('.gz')
+    if gzipped:
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    return stream
+
+
+def open_output(path):
+    '''Open path ('-' for stdout) for writing, compressing it if it ends in .gz.'''
+    if path == '-':
+        return getattr(sys.stdout, 'buffer', sys.stdout)
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def close_output(stream, path):
+    '''Close a stream from open_output, or just flush it if it's stdout.'''
+    if path == '-':
+        stream.flush()
+    else:
+        stream.close()
+
+
+def read_lines(paths):
+    '''Yield each non-empty line of each of the paths, without its line ending.'''
+    for path in paths:
+        stream = open_input(path)
+        try:
+            for line in stream:
+                line = line.rstrip(b'\r\n')
+                if line:
+                    yield line
+        finally:
+            if path != '-':
+                stream.close()
+
+
+def chunked(iterable, size):
+    '''Yield lists of up to size items from iterable.'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def imap_bounded(pool, function, iterable, limit):
+    '''
+    Like pool.imap, but with at most limit items in flight at a time. Pool.imap
+    consumes iterable as quickly as it can, which would read all of a large input
+    into memory.
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= limit:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class DeparamAction(argparse.Action):
+    '''Append a deparam step for a comma-separated list of parameters.'''
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        steps = getattr(namespace, self.dest) or []
+        steps.append(('deparam', [p for p in values.split(',') if p]))
+        setattr(namespace, self.dest, steps)
+
+
+def parser():
+    '''Return the argument parser for the command line.'''
+    result = argparse.ArgumentParser(
+        prog='python -m url',
+        description='Normalize newline-delimited urls, writing the results in order.')
+    result.add_argument('paths', metavar='FILE', nargs='*', default=['-'],
+        help='Files of urls, possibly gzipped (default: stdin)')
+    result.add_argument('-o', '--output', default='-',
+        help='Where to write results, gzipped if it ends in .gz (default: stdout)')
+    result.add_argument('--rejects',
+        help='Where to write urls that could not be parsed (default: discard them)')
+    result.add_argument('--pld', action='store_true',
+        help='Add a tab-separated pld column')
+    result.add_argument('--tld', action='store_true',
+        help='Add a tab-separated tld column')
+    result.add_argument('--psl',
+        help='A public suffix list, in text or compiled form, to use for --pld and --tld')
+    result.add_argument('-j', '--processes', type=int, default=None,
+        help='Number of worker processes (default: one per cpu)')
+    result.add_argument('--chunk-size', type=int, default=10000,
+        help='Number of urls sent to a worker at a time (default: %(default)s)')
+
+    operations = result.add_argument_group(
+        'operations', 'Applied to each url in the order that they are given')
+    for name in ('strip', 'abspath', 'escape', 'unescape', 'canonical', 'defrag',
+                 'deuserinfo', 'punycode', 'unpunycode', 'remove_default_port',
+                 'sanitize'):
+        operations.add_argument('--' + name.replace('_', '-'),
+            dest='steps', action='append_const', const=name)
+    operations.add_argument('--escape-strict',
+        dest='steps', action='append_const', const=('escape', True))
+    operations.add_argument('--deparam', metavar='PARAMS',
+        dest='steps', action=DeparamAction,
+        help="Remove a comma-separated list of parameters, like 'sid,utm_*'")
+    return result
+
+
+def main(argv=None):
+    arguments = parser()
+    args = arguments.parse_args(argv)
+    steps = args.steps or []
+    initargs = (steps, args.pld, args.tld, args.psl)
+    # Fail on a bad configuration here, rather than in every worker. A worker that
+    # fails to initialize is just replaced, so the pool would never finish.
+    Pipeline(compile_steps(steps))
+    if args.psl is not None:
+        try:
+            PSL.from_file(args.psl)
+        except (IOError, OSError, ValueError) as error:
+            arguments.error('could not load --psl %s: %s' % (args.psl, error))
+
+    processes = args.processes or multiprocessing.cpu_count()
+    chunks = chunked(read_lines(args.paths), args.chunk_size)
+    if processes == 1:
+        pool = None
+        initialize(*initargs)
+        results = map(process, chunks)
+    else:
+        pool = multiprocessing.Pool(processes, initialize, initargs)
+        results = imap_bounded(pool, process, chunks, 2 * processes)
+
+    output = open_output(args.output)
+    rejects = open_output(args.rejects) if args.rejects else None
+    try:
+        for processed, rejected in results:
+            output.writelines(row + b'\n' for row in processed)
+            if rejects is not None:
+                rejects.writelines(line + b'\n' for line in rejected)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        close_output(output, args.output)
+        if rejects is not None:
+            close_output(rejects, args.rejects)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
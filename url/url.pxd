@@ -7,24 +7,39 @@ from libcpp.unordered_set cimport unordered_set
 from libcpp cimport bool
 
 
-cdef extern from "url-cpp/include/psl.h" namespace "Url":
-    cpdef cppclass PSL:
-        PSL()
-        PSL(const PSL& other)
-        PSL& operator=(const PSL& other)
-        @staticmethod
-        PSL fromPath(const string& path)
-        @staticmethod
-        PSL fromString(const string& path)
-        string getTLD(const string& host) except +
-        string getPLD(const string& host) except +
-
-
-cdef extern from "url-cpp/include/url.h" namespace "Url":
+cdef extern from "<regex>" namespace "std::regex_constants" nogil:
+    ctypedef enum syntax_option_type:
+        ECMAScript
+        icase
+        nosubs
+        optimize
+
+
+cdef extern from "<regex>" namespace "std" nogil:
+    cppclass regex:
+        regex()
+        regex(const string& pattern, syntax_option_type flags) except +ValueError
+
+    bool regex_search(const string& s, const regex& pattern) except +ValueError
+    bool regex_search(
+        const char* first, const char* last, const regex& pattern) except +ValueError
+
+
+cdef extern from "url-cpp/include/punycode.h" namespace "Url::Punycode" nogil:
+    string encodeHostname(const string& hostname) except +ValueError
+
+
+cdef extern from "url-cpp/include/url.h" namespace "Url" nogil:
+    cppclass CharacterClass:
+        bool operator()(char c) const
+
+    const CharacterClass SCHEME "Url::Url::SCHEME"
+
     cpdef cppclass Url:
         Url(const string& url) except +ValueError
+        Url(const Url& other)
         Url& assign(const Url& other)
-        bool equiv(const Url& other)
+        bool equiv(const Url& other) except +ValueError
         bool operator==(const Url& other)
 
         # Getters
@@ -1,12 +1,43 @@
-# cython: linetrace=True
-# distutils: define_macros=CYTHON_TRACE=1
-
 from six import text_type
 
+from collections import namedtuple
 from cython.operator import dereference
+from libc.stdint cimport uint8_t, uint32_t, uint64_t
+from cpython cimport array
+from cpython.buffer cimport PyBuffer_FillInfo
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.ref cimport PyObject, Py_INCREF, Py_DECREF, Py_XDECREF
+from cpython.unicode cimport PyUnicode_DecodeLatin1, PyUnicode_DecodeUTF8
+from libc.string cimport memcmp, memcpy, memset
+from libcpp.algorithm cimport sort
+from libcpp.memory cimport shared_ptr
+from libcpp.string cimport npos, to_string
+from libcpp.unordered_map cimport unordered_map
+from libcpp.utility cimport move
+from libcpp.vector cimport vector
+import itertools
+import mmap
+import os
 import pkgutil
 
-cdef PSL psl = PSL.fromString(pkgutil.get_data('url', 'psl/2016-08-16.psl'))
+cdef extern from *:
+    '''
+    #ifndef CYTHON_TRACE
+    #define CYTHON_TRACE 0
+    #endif
+    '''
+    bint CYTHON_TRACE
+
+# Which variant of the extension this is: 'release', or 'profile' with line tracing
+BUILD = 'profile' if CYTHON_TRACE else 'release'
+
+# Sentinel passed to __cinit__ by callers that provide their own Url
+cdef object unparsed = object()
+
+cdef extern from "<ctype.h>" nogil:
+    int isdigit(int c)
+    int isspace(int c)
+    int tolower(int c)
 
 def ParseMethod(cls, s, encoding='utf-8'):
     if isinstance(s, bytes):
@@ -17,87 +48,1634 @@ def ParseMethod(cls, s, encoding='utf-8'):
     else:
         return cls(s.encode('utf-8'))
 
+def ParseManyMethod(cls, urls, encoding='utf-8'):
+    '''Parse each of the provided url strings, returning a list of URL objects'''
+    return parse_many(cls, urls, encoding)
+
+cdef list parse_many(type cls, urls, encoding):
+    cdef uint64_t started = stats_start()
+    cdef vector[string] strings = as_utf8_vector(urls, encoding)
+    cdef vector[Url*] parsed
+    cdef size_t i
+    parsed.reserve(strings.size())
+    try:
+        with nogil:
+            for i in range(strings.size()):
+                parsed.push_back(new Url(strings[i]))
+    except:
+        if parsed.size() < strings.size():
+            stats_parse_failed(strings[parsed.size()], PARSE_OK)
+        for i in range(parsed.size()):
+            del parsed[i]
+        raise
+
+    cdef list result = []
+    cdef StringURL url
+    for i in range(parsed.size()):
+        url = cls.__new__(cls, unparsed)
+        url.ptr = parsed[i]
+        result.append(url)
+    stats_stop(STATS_PARSE_MANY, started)
+    return result
+
+# Why try_parse_many couldn't parse a string, if it couldn't
+cpdef enum ParseError:
+    PARSE_OK
+    PARSE_INVALID_PORT
+    PARSE_PORT_OUT_OF_RANGE
+    PARSE_INVALID_ENCODING
+
+cdef extern from *:
+    '''
+    #include <cerrno>
+    #include <climits>
+    #include <cstdlib>
+
+    // Return why the port of url is invalid, or 0 if it isn't. This finds and reads the
+    // port the same way that the Url constructor does, but without the cost of throwing.
+    static int url_check_port(const std::string& url)
+    {
+        size_t start = 2;
+        size_t index = url.find(':');
+        if (index != std::string::npos && url.compare(index + 1, 2, "//") == 0)
+        {
+            start = index + 3;
+            for (size_t i = 0; i < index; ++i)
+            {
+                if (!Url::Url::SCHEME(url[i]))
+                {
+                    start = 2;
+                    break;
+                }
+            }
+        }
+        if (start == 2 && url.compare(0, 2, "//") != 0)
+        {
+            return 0;
+        }
+
+        std::string host(url, start, url.find_first_of("/?#", start) - start);
+        index = host.find('@');
+        if (index != std::string::npos)
+        {
+            host.erase(0, index + 1);
+        }
+        index = host.find(':');
+        if (index == std::string::npos || index + 1 == host.size())
+        {
+            return 0;
+        }
+
+        // std::stoi is strtol with some range checks
+        std::string port(host, index + 1, std::string::npos);
+        const char* begin = port.c_str();
+        char* end;
+        errno = 0;
+        long value = std::strtol(begin, &end, 10);
+        if (end == begin)
+        {
+            return 1;
+        }
+        if (errno == ERANGE || value < INT_MIN || value > INT_MAX)
+        {
+            return 2;
+        }
+        if (end != begin + port.size())
+        {
+            return 1;
+        }
+        return (value < 0 || value > 65535) ? 2 : 0;
+    }
+
+    // Parse s into *result, returning why it couldn't be parsed rather than throwing
+    static int url_try_parse(const std::string& s, Url::Url** result)
+    {
+        int error = url_check_port(s);
+        *result = NULL;
+        if (error != 0)
+        {
+            return error;
+        }
+        try
+        {
+            *result = new Url::Url(s);
+            return 0;
+        }
+        catch (const Url::UrlParseException& e)
+        {
+            if (std::string(e.what()).compare(0, 17, "Port not a number") == 0)
+            {
+                return 1;
+            }
+            return 2;
+        }
+    }
+    '''
+    int url_try_parse(const string& s, Url** result) nogil except +
+
+def TryParseMethod(cls, s, encoding='utf-8'):
+    '''Parse the provided url string, returning None if it can't be parsed'''
+    cdef uint64_t started = stats_start()
+    cdef string c_s
+    cdef Url* parsed
+    cdef ParseError error
+    try:
+        c_s = as_utf8(s, encoding)
+    except UnicodeError:
+        stats_parse_failed(c_s, PARSE_INVALID_ENCODING)
+        stats_stop(STATS_TRY_PARSE, started)
+        return None
+    with nogil:
+        error = <ParseError>url_try_parse(c_s, &parsed)
+    if error != PARSE_OK:
+        stats_parse_failed(c_s, error)
+        stats_stop(STATS_TRY_PARSE, started)
+        return None
+    cdef StringURL url = cls.__new__(cls, unparsed)
+    url.ptr = parsed
+    stats_stop(STATS_TRY_PARSE, started)
+    return url
+
+def TryParseManyMethod(cls, urls, encoding='utf-8'):
+    '''
+    Parse each of the provided url strings, returning a list of URL objects (or None
+    for those that can't be parsed), and an array('B') of the ParseError for each.
+    '''
+    return try_parse_many(cls, urls, encoding)
+
+cdef tuple try_parse_many(type cls, urls, encoding):
+    cdef uint64_t started = stats_start()
+    cdef vector[string] strings
+    cdef vector[uint8_t] codes
+    cdef bint utf8 = encoding == 'utf-8'
+    for s in urls:
+        if utf8 and isinstance(s, bytes):
+            strings.push_back(<bytes>s)
+            codes.push_back(PARSE_OK)
+            continue
+        try:
+            strings.push_back(as_utf8(s, encoding))
+            codes.push_back(PARSE_OK)
+        except UnicodeError:
+            strings.push_back(string())
+            codes.push_back(PARSE_INVALID_ENCODING)
+
+    cdef vector[Url*] parsed
+    cdef size_t i
+    parsed.resize(strings.size(), NULL)
+    try:
+        with nogil:
+            for i in range(strings.size()):
+                if codes[i] == PARSE_OK:
+                    codes[i] = url_try_parse(strings[i], &parsed[i])
+    except:
+        for i in range(parsed.size()):
+            del parsed[i]
+        raise
+
+    if stats_enabled:
+        for i in range(codes.size()):
+            if codes[i] != PARSE_OK:
+                stats_parse_failed(strings[i], <ParseError>codes[i])
+
+    cdef array.array errors = array.clone(array.array('B'), codes.size(), False)
+    if codes.size():
+        memcpy(errors.data.as_uchars, codes.data(), codes.size())
+    cdef list result = []
+    cdef StringURL url
+    for i in range(parsed.size()):
+        if parsed[i] == NULL:
+            result.append(None)
+        else:
+            url = cls.__new__(cls, unparsed)
+            url.ptr = parsed[i]
+            result.append(url)
+    stats_stop(STATS_TRY_PARSE_MANY, started)
+    return result, errors
+
+cdef string as_utf8(s, encoding) except *:
+    if isinstance(s, bytes):
+        if encoding == 'utf-8':
+            return <bytes>s
+        return s.decode(encoding).encode('utf-8')
+    return s.encode('utf-8')
+
+cdef vector[string] as_utf8_vector(strings, encoding) except *:
+    cdef vector[string] result
+    if encoding == 'utf-8':
+        for s in strings:
+            if isinstance(s, bytes):
+                result.push_back(<bytes>s)
+            else:
+                result.push_back(s.encode('utf-8'))
+    else:
+        for s in strings:
+            if isinstance(s, bytes):
+                result.push_back(s.decode(encoding).encode('utf-8'))
+            else:
+                result.push_back(s.encode('utf-8'))
+    return result
+
+###############################################################################
+# Interning
+###############################################################################
+
+# The bytes and decoded unicode objects for a string in the intern pool, each made the
+# first time it's needed
+cdef struct Interned:
+    PyObject* raw
+    PyObject* text
+
+ctypedef unordered_map[string, Interned] InternMap
+
+InternPoolInfo = namedtuple(
+    'InternPoolInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+def set_intern_pool_size(maxsize):
+    '''
+    Share the objects for up to maxsize distinct hosts, schemes, plds and tlds between
+    urls, or disable the pool with 0 (the default).
+    '''
+    if maxsize < 0:
+        raise ValueError('Pool size must be non-negative')
+    intern_pool.clear()
+    intern_pool.maxsize = maxsize
+
+def intern_pool_info():
+    '''Return the hits, misses, evictions, maxsize and currsize of the intern pool.'''
+    return InternPoolInfo(
+        intern_pool.hits, intern_pool.misses, intern_pool.evictions,
+        intern_pool.maxsize, intern_pool.size())
+
+cdef class InternPool:
+    '''
+    A bounded pool of the objects for strings that many urls have in common, so that
+    they're only allocated once. Like PSLCache, it has two generations: strings are
+    found in either, and added to the recent one. Once that holds half of maxsize, it
+    becomes the older one, and the strings in the older one are dropped.
+    '''
+
+    cdef InternMap recent
+    cdef InternMap older
+    cdef size_t maxsize
+    cdef size_t hits
+    cdef size_t misses
+    cdef size_t evictions
+
+    def __dealloc__(self):
+        self.clear()
+
+    cdef size_t size(self):
+        return self.recent.size() + self.older.size()
+
+    cdef void drop(self, InternMap* strings):
+        for item in dereference(strings):
+            Py_XDECREF(item.second.raw)
+            Py_XDECREF(item.second.text)
+        strings.clear()
+
+    cdef void clear(self):
+        self.drop(&self.recent)
+        self.drop(&self.older)
+        self.hits = self.misses = self.evictions = 0
+
+    cdef object get(self, const string& s, bint decoded):
+        '''Return s as bytes (or decoded as utf-8), adding it to the pool.'''
+        cdef unordered_map[string, Interned].iterator found
+        cdef Interned* entry
+        found = self.recent.find(<string&>s)
+        if found != self.recent.end():
+            entry = &dereference(found).second
+        else:
+            found = self.older.find(<string&>s)
+            if found != self.older.end():
+                entry = &self.recent[s]
+                entry[0] = dereference(found).second
+                self.older.erase(found)
+            else:
+                entry = &self.recent[s]
+                entry.raw = entry.text = NULL
+
+        cdef PyObject** slot = &entry.text if decoded else &entry.raw
+        cdef object result
+        if slot[0] != NULL:
+            self.hits += 1
+            result = <object>slot[0]
+        else:
+            self.misses += 1
+            if decoded:
+                result = decode(s)
+            else:
+                result = PyBytes_FromStringAndSize(s.data(), s.size())
+            Py_INCREF(result)
+            slot[0] = <PyObject*>result
+
+        if 2 * self.recent.size() >= self.maxsize:
+            self.evictions += self.older.size()
+            self.drop(&self.older)
+            self.older.swap(self.recent)
+        return result
+
+cdef InternPool intern_pool = InternPool()
+
+cdef inline object pooled(const string& s, bint decoded):
+    '''Return s as bytes (or decoded as utf-8), shared through the pool if it's on.'''
+    if intern_pool.maxsize:
+        return intern_pool.get(s, decoded)
+    if decoded:
+        return decode(s)
+    return PyBytes_FromStringAndSize(s.data(), s.size())
+
+###############################################################################
+# Public suffix list
+###############################################################################
+
+# Compiled PSLs are laid out as follows, with all integers little-endian uint32:
+#
+#   magic                     PSL_MAGIC
+#   count, table_size         the number of rules, and slots in the hash table
+#   table[table_size]         1 + index of the rule in each slot, or 0 if empty
+#   offsets[count + 1]        offsets of each reversed rule in strings
+#   levels[count]             uint8 number of segments in the suffix for each rule
+#   strings                   concatenated reversed rules
+#
+# The hash table uses FNV-1a and linear probing. Rules are stored reversed, as in
+# url-cpp, so that suffixes are found by trimming segments off the end of the key.
+cdef bytes PSL_MAGIC = b'URLPSL\x00\x01'
+cdef size_t HEADER_SIZE = len(PSL_MAGIC) + 8
+
+cdef inline uint32_t read_uint32(const uint8_t* data) nogil:
+    return data[0] | (data[1] << 8) | (data[2] << 16) | (<uint32_t>data[3] << 24)
+
+cdef uint32_t FNV_OFFSET = 2166136261
+cdef uint32_t FNV_PRIME = 16777619
+
+cdef inline uint32_t fnv1a(const char* data, size_t length) nogil:
+    cdef uint32_t result = FNV_OFFSET
+    cdef size_t i
+    for i in range(length):
+        result = (result ^ <uint8_t>data[i]) * FNV_PRIME
+    return result
+
+cdef bint last_segments(const string& hostname, size_t segments, string* result) nogil:
+    '''
+    Set result to the last `segments` segments of a hostname, lowercased, or empty if
+    there aren't that many. Return False if the result has an empty segment.
+    '''
+    cdef size_t position = hostname.size()
+    cdef size_t remaining = segments
+    cdef size_t i
+    while remaining != 0 and position and position != npos:
+        position = hostname.rfind(<char>b'.', position - 1)
+        remaining -= 1
+
+    if remaining >= 1:
+        result.clear()
+        return True
+
+    result.assign(hostname, 0 if position == npos else position + 1, npos)
+    for i in range(result.size()):
+        result[0][i] = tolower(result[0][i])
+    return result.empty() or result[0][0] != b'.'
+
+cdef class PSL:
+    '''
+    A public suffix list. PSL(buffer) uses a compiled PSL from compile_psl, in any
+    object supporting contiguous buffers (like mmap), and from_text and from_file load
+    one from the rules. A writable buffer is copied, since it's only checked once. PSLs
+    are immutable, so one may be shared by any number of threads.
+    '''
+
+    cdef const uint8_t[::1] buffer
+    cdef uint32_t count
+    cdef uint32_t table_size
+    cdef const uint8_t* table
+    cdef const uint8_t* offsets
+    cdef const uint8_t* levels
+    cdef const char* strings
+
+    def __cinit__(self, buffer):
+        view = memoryview(buffer)
+        if not view.c_contiguous:
+            raise ValueError('Compiled PSL is not in a contiguous buffer.')
+        # Lookups trust the buffer once it's checked, so it mustn't change afterwards
+        if not view.readonly:
+            buffer = view.tobytes()
+        self.buffer = buffer
+        cdef size_t size = self.buffer.shape[0]
+        if size < HEADER_SIZE or memcmp(
+                &self.buffer[0], <const char*>PSL_MAGIC, len(PSL_MAGIC)) != 0:
+            raise ValueError('Not a compiled PSL.')
+        cdef const uint8_t* data = &self.buffer[0]
+        self.count = read_uint32(data + len(PSL_MAGIC))
+        self.table_size = read_uint32(data + len(PSL_MAGIC) + 4)
+        cdef size_t strings_offset = (
+            HEADER_SIZE + 4 * <size_t>self.table_size + 5 * <size_t>self.count + 4)
+        if ((self.table_size & (self.table_size - 1)) or
+                self.table_size <= self.count or
+                strings_offset > size):
+            raise ValueError('Compiled PSL is truncated or corrupt.')
+        self.table = data + HEADER_SIZE
+        self.offsets = self.table + 4 * <size_t>self.table_size
+        self.levels = self.offsets + 4 * (<size_t>self.count + 1)
+        self.strings = <const char*>(data + strings_offset)
+        # Make sure lookups can't read outside of the buffer, and that every probe
+        # ends at an empty slot
+        cdef uint32_t i, entry
+        cdef bint has_empty = False
+        for i in range(self.table_size):
+            entry = read_uint32(self.table + 4 * i)
+            if entry > self.count:
+                raise ValueError('Compiled PSL is truncated or corrupt.')
+            has_empty = has_empty or entry == 0
+        if not has_empty:
+            raise ValueError('Compiled PSL is truncated or corrupt.')
+        for i in range(self.count):
+            if read_uint32(self.offsets + 4 * i) > read_uint32(self.offsets + 4 * i + 4):
+                raise ValueError('Compiled PSL is truncated or corrupt.')
+        if read_uint32(self.offsets + 4 * self.count) > size - strings_offset:
+            raise ValueError('Compiled PSL is truncated or corrupt.')
+
+    cdef int find(self, uint32_t hash, const string& hostname, size_t length) nogil:
+        '''
+        Return the level of the rule matching the last `length` characters of hostname,
+        reversed and lowercased (and whose hash is provided), or -1 if there is none.
+        '''
+        cdef uint32_t mask = self.table_size - 1
+        cdef uint32_t slot = hash & mask
+        cdef uint32_t entry, start, probe
+        cdef size_t i, last = hostname.size() - 1
+        for probe in range(self.table_size):
+            entry = read_uint32(self.table + 4 * slot)
+            if entry == 0:
+                return -1
+            entry -= 1
+            start = read_uint32(self.offsets + 4 * entry)
+            if read_uint32(self.offsets + 4 * (entry + 1)) - start == length:
+                for i in range(length):
+                    if self.strings[start + i] != <char>tolower(hostname[last - i]):
+                        break
+                else:
+                    return self.levels[entry]
+            slot = (slot + 1) & mask
+        return -1
+
+    cdef size_t tld_length(self, const string& hostname) nogil:
+        '''Return the number of segments in the TLD of the provided hostname.'''
+        # The longest rule matching a suffix of the hostname that ends in a whole
+        # segment wins. Every such suffix is probed as it's hashed, shortest first.
+        cdef uint32_t hash = FNV_OFFSET
+        cdef size_t i, length = hostname.size()
+        cdef char c
+        cdef int level, result = -1
+        for i in range(length):
+            c = tolower(hostname[length - 1 - i])
+            if c == b'.' and i > 0:
+                level = self.find(hash, hostname, i)
+                if level >= 0:
+                    result = level
+            hash = (hash ^ <uint8_t>c) * FNV_PRIME
+        if length:
+            level = self.find(hash, hostname, length)
+            if level >= 0:
+                result = level
+        return 1 if result < 0 else result
+
+    cdef tuple lookup(self, const string& hostname):
+        '''Return (tld, pld) of the hostname, where pld is None if it has empty segments.'''
+        cdef string tld, pld
+        cdef bint tld_valid, pld_valid
+        cdef size_t length
+        with nogil:
+            length = self.tld_length(hostname)
+            tld_valid = last_segments(hostname, length, &tld)
+            pld_valid = last_segments(hostname, length + 1, &pld)
+        if not tld_valid:
+            raise ValueError('Empty segment in %s' % tld.decode('utf-8', 'replace'))
+        if not pld_valid:
+            return (pooled(tld, False), None)
+        return (pooled(tld, False), pooled(pld, False))
+
+    cdef bytes checked_pld(self, const string& hostname):
+        '''Return the pld of the hostname, raising ValueError if it has empty segments.'''
+        cdef string pld
+        if not last_segments(hostname, self.tld_length(hostname) + 1, &pld):
+            raise ValueError('Empty segment in %s' % pld.decode('utf-8', 'replace'))
+        return pld
+
+    @classmethod
+    def from_text(cls, rules):
+        '''Return the PSL of the provided rules, as a string.'''
+        return cls(compile_psl(rules))
+
+    @classmethod
+    def from_file(cls, path):
+        '''
+        Return the PSL in the file at path, either mapping a compiled PSL from
+        compile_psl, or compiling the rules.
+        '''
+        with open(path, 'rb') as fin:
+            if fin.read(len(PSL_MAGIC)) == PSL_MAGIC:
+                return cls(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+            fin.seek(0)
+            return cls.from_text(fin.read())
+
+    @classmethod
+    def bundled(cls):
+        '''Return the PSL that comes with this library.'''
+        return bundled_psl
+
+    def pld(self, host):
+        '''
+        Return the pld of host with this PSL. host may be a URL, which gives what its
+        pld property would, or a hostname or url string as for pld_many, which gives
+        a string of the same type.
+        '''
+        return self.find_component(host, True)
+
+    def tld(self, host):
+        '''Return the tld of host with this PSL, as pld does.'''
+        return self.find_component(host, False)
+
+    cdef find_component(self, host, bint want_pld):
+        cdef string hostname, text
+        cdef bint decoded
+        if isinstance(host, StringURL):
+            hostname = (<StringURL>host).ptr.host()
+            decoded = isinstance(host, UnicodeURL)
+        else:
+            text = as_bytes(host)
+            decoded = isinstance(host, unicode)
+            host_of_host_or_url(text, &hostname)
+        result = find_pld(self, hostname) if want_pld else find_tld(self, hostname)
+        return pooled(result, True) if decoded else result
+
+    def __len__(self):
+        return self.count
+
+cdef void reverse_into(const string& source, size_t trim, string* result) nogil:
+    '''Set result to source reversed, without its first `trim` characters.'''
+    cdef size_t length = source.size() - trim
+    cdef size_t i
+    result.resize(length)
+    for i in range(length):
+        result[0][i] = source[source.size() - 1 - i]
+
+cdef inline void append_uint32(string* result, uint32_t value) nogil:
+    result.push_back(<char>(value & 0xFF))
+    result.push_back(<char>((value >> 8) & 0xFF))
+    result.push_back(<char>((value >> 16) & 0xFF))
+    result.push_back(<char>((value >> 24) & 0xFF))
+
+cdef int add_rule(
+        unordered_map[string, uint8_t]* levels, const string& rule, int level_adjust,
+        size_t trim) nogil except -1:
+    '''Add both the unpunycoded and punycoded forms of a rule, as url-cpp does.'''
+    cdef string key
+    cdef size_t i, level = 1 + level_adjust
+    reverse_into(rule, trim, &key)
+    for i in range(key.size()):
+        if key[i] == b'.':
+            level += 1
+    if level > 255:
+        with gil:
+            raise ValueError('Rule has too many segments: %s' % rule.decode('utf-8'))
+    levels[0][key] = level
+    reverse_into(encodeHostname(rule), trim, &key)
+    levels[0][key] = level
+    return 0
+
+def compile_psl(rules):
+    '''Compile PSL rules (as a string) into the binary form accepted by set_psl.'''
+    cdef string text = as_bytes(rules)
+    cdef string result = PSL_MAGIC
+    with nogil:
+        compile_rules(text, &result)
+    return result
+
+cdef int compile_rules(const string& text, string* result) nogil except -1:
+    '''Append the compiled form of the PSL rules in text to result.'''
+    cdef unordered_map[string, uint8_t] levels
+    cdef string rule
+    cdef size_t start = 0, end, length
+    while start < text.size():
+        end = text.find(b'\n', start)
+        if end == npos:
+            end = text.size()
+        # Only take up to the first whitespace, skipping blanks and comments
+        length = 0
+        while start + length < end and not isspace(text[start + length]):
+            length += 1
+        rule.assign(text, start, length)
+        start = end + 1
+
+        if rule.empty() or rule.compare(0, 2, b'//') == 0:
+            continue
+        if rule[0] == b'*':
+            if rule.size() <= 2 or rule[1] != b'.':
+                with gil:
+                    raise ValueError('Wildcard rule must be of form *.<host>')
+            add_rule(&levels, rule, 1, 2)
+        elif rule[0] == b'!':
+            if rule.size() <= 1:
+                with gil:
+                    raise ValueError('Exception rule has no hostname.')
+            add_rule(&levels, rule, -1, 1)
+        else:
+            add_rule(&levels, rule, 0, 0)
+
+    cdef vector[string] keys
+    for entry in levels:
+        keys.push_back(entry.first)
+    sort(keys.begin(), keys.end())
+
+    cdef uint32_t table_size = 1
+    while table_size <= 2 * keys.size():
+        table_size *= 2
+    cdef vector[uint32_t] table = vector[uint32_t](table_size, 0)
+    cdef uint32_t mask = table_size - 1
+    cdef uint32_t index, slot, offset = 0
+
+    append_uint32(result, keys.size())
+    append_uint32(result, table_size)
+    for index in range(keys.size()):
+        slot = fnv1a(keys[index].data(), keys[index].size()) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = index + 1
+    for slot in table:
+        append_uint32(result, slot)
+    for index in range(keys.size()):
+        append_uint32(result, offset)
+        offset += keys[index].size()
+    append_uint32(result, offset)
+    for index in range(keys.size()):
+        result.push_back(<char>levels[keys[index]])
+    for index in range(keys.size()):
+        result.append(keys[index])
+    return 0
+
+cdef PSL as_psl(rules):
+    '''Return a PSL from either a PSL, rules as a string, or a compiled PSL.'''
+    if isinstance(rules, PSL):
+        return rules
+    if not isinstance(rules, text_type):
+        view = memoryview(rules)
+        if view[:len(PSL_MAGIC)].tobytes() == PSL_MAGIC:
+            return PSL(view)
+    return PSL(compile_psl(rules))
+
+cdef PSL load_bundled_psl():
+    '''Map the bundled compiled PSL, falling back to compiling the bundled rules.'''
+    path = os.path.join(os.path.dirname(__file__), 'psl', '2016-08-16.psl.bin')
+    try:
+        with open(path, 'rb') as fin:
+            return PSL(mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ))
+    except (IOError, OSError):
+        return PSL(compile_psl(pkgutil.get_data('url', 'psl/2016-08-16.psl')))
+
+cdef PSL bundled_psl = load_bundled_psl()
+
+# The default PSL. Readers take their own reference while holding the GIL (with
+# chosen_psl) and use only that, so that set_psl may swap it out at any time, even
+# while lookups are running without the GIL.
+cdef PSL psl = bundled_psl
+
 def set_psl(rules):
+    '''
+    Use the provided PSL by default for pld and tld. This may be a PSL, the rules as a
+    string, or a compiled PSL from compile_psl, in any object supporting buffers (like
+    mmap). Rules are compiled before the default is replaced, without holding the GIL,
+    so this may be called from a background thread while others use the old PSL.
+    '''
     global psl
-    psl = PSL.fromString(as_bytes(rules))
+    cdef PSL new = as_psl(rules)
+    psl = new
+    psl_cache.clear()
+
+def get_psl():
+    '''Return the default PSL.'''
+    return psl
+
+cdef PSL chosen_psl(choice):
+    '''Return choice, which must be a PSL, or the default PSL if it's None.'''
+    if choice is None:
+        return psl
+    return <PSL?>choice
+
+PSLCacheInfo = namedtuple(
+    'PSLCacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+def set_psl_cache_size(maxsize):
+    '''Cache the pld and tld of up to maxsize hosts, or disable the cache with 0.'''
+    if maxsize < 0:
+        raise ValueError('Cache size must be non-negative')
+    psl_cache.maxsize = maxsize
+    psl_cache.clear()
+
+def psl_cache_info():
+    '''Return the hits, misses, evictions, maxsize and currsize of the PSL cache.'''
+    return PSLCacheInfo(
+        psl_cache.hits, psl_cache.misses, psl_cache.evictions,
+        psl_cache.maxsize, psl_cache.size())
+
+cdef class PSLCache:
+    '''
+    A cache of host => (tld, pld) in front of the PSL, approximating least-recently-used
+    eviction with two generations. Hits are promoted into the recent generation, and
+    when the cache is full, hosts are evicted from the older generation. Once that's
+    empty, the recent generation becomes the older one.
+    '''
+
+    cdef dict recent
+    cdef dict older
+    # The hosts in the older generation from least to most recently inserted
+    cdef list eviction_order
+    cdef size_t next_eviction
+    cdef size_t maxsize
+    cdef size_t hits
+    cdef size_t misses
+    cdef size_t evictions
+    # Incremented whenever the PSL changes, so in-flight lookups aren't cached
+    cdef size_t generation
+
+    def __cinit__(self, size_t maxsize):
+        self.recent = {}
+        self.older = {}
+        self.maxsize = maxsize
+
+    cdef size_t size(self):
+        return len(self.recent) + len(self.older)
+
+    cdef clear(self):
+        self.recent.clear()
+        self.older.clear()
+        self.eviction_order = None
+        self.hits = self.misses = self.evictions = 0
+        self.generation += 1
+
+    cdef insert(self, bytes key, tuple result):
+        if self.size() >= self.maxsize:
+            if not self.older:
+                self.recent, self.older = self.older, self.recent
+                self.eviction_order = list(self.older)
+                self.next_eviction = 0
+            # Skip over any hosts that have since been promoted
+            while self.older.pop(self.eviction_order[self.next_eviction], None) is None:
+                self.next_eviction += 1
+            self.next_eviction += 1
+            self.evictions += 1
+        self.recent[key] = result
+
+    cdef tuple lookup(self, PSL current, const string& host):
+        '''Return (tld, pld) for host with current, which must be the default PSL.'''
+        cdef bytes key
+        cdef tuple result
+        if self.maxsize:
+            key = host
+            result = self.recent.get(key)
+            if result is None:
+                result = self.older.pop(key, None)
+                if result is not None:
+                    self.insert(key, result)
+            if result is not None:
+                self.hits += 1
+                return result
+
+        self.misses += 1
+        cdef size_t generation = self.generation
+        result = current.lookup(host)
+
+        if self.maxsize and generation == self.generation:
+            self.insert(key, result)
+        return result
+
+cdef PSLCache psl_cache = PSLCache(10000)
+
+cdef tuple psl_lookup(PSL current, const string& host):
+    '''Return (tld, pld) for host with current, through the cache for the default.'''
+    stats_psl_looked_up(1)
+    if current is psl:
+        return psl_cache.lookup(current, host)
+    return current.lookup(host)
+
+cdef bytes find_pld(PSL current, const string& host):
+    '''Return the pld of host with current, raising ValueError if it can't be found.'''
+    if host.empty():
+        return b''
+    pld = psl_lookup(current, host)[1]
+    if pld is None:
+        # Raises the reason the pld couldn't be determined
+        return current.checked_pld(host)
+    return pld
+
+cdef bytes find_tld(PSL current, const string& host):
+    '''Return the tld of host with current, raising ValueError if it can't be found.'''
+    if host.empty():
+        return b''
+    return psl_lookup(current, host)[0]
+
+def pld_many(hosts_or_urls, packed=False, psl=None):
+    '''
+    Return the pld of each of the provided hosts or urls, with psl or else the default
+    PSL. Strings containing a '/' are treated as urls and everything else as a
+    hostname, with any userinfo and port removed. If packed, return the plds
+    concatenated into one string, and an array of offsets where each begins and ends.
+    '''
+    cdef uint64_t started = stats_start()
+    cdef vector[string] results = psl_many(hosts_or_urls, 1, chosen_psl(psl))
+    stats_stop(STATS_PLD_MANY, started)
+    return pack_pooled(results, packed)
+
+def tld_many(hosts_or_urls, packed=False, psl=None):
+    '''Return the tld of each of the provided hosts or urls, as pld_many does.'''
+    cdef uint64_t started = stats_start()
+    cdef vector[string] results = psl_many(hosts_or_urls, 0, chosen_psl(psl))
+    stats_stop(STATS_TLD_MANY, started)
+    return pack_pooled(results, packed)
+
+cdef void host_of(const string& url, string* host) nogil:
+    '''Set host to the lowercased hostname of url, as Url's constructor finds it.'''
+    cdef size_t position = 0
+    cdef size_t index = url.find(b':')
+    cdef size_t i
+    if index != npos:
+        # If there's a scheme, then '//' would follow it
+        for i in range(index):
+            if not SCHEME(url[i]):
+                break
+        else:
+            position = index + 1
+
+    host.clear()
+    if position + 1 < url.size() and url[position] == b'/' and url[position + 1] == b'/':
+        position += 2
+        index = url.find_first_of(b'/?#', position)
+        host.assign(url, position, npos if index == npos else index - position)
+
+        index = host.find(b'@')
+        if index != npos:
+            host.erase(0, index + 1)
+        index = host.find(b':')
+        if index != npos:
+            host.resize(index)
+        for i in range(host.size()):
+            host[0][i] = tolower(host[0][i])
+
+cdef void host_of_host_or_url(const string& text, string* host) nogil:
+    '''
+    Set host to the hostname of text, which is a url if it contains a '/', or else a
+    hostname that may have userinfo and a port (like 'user@example.com:8080').
+    '''
+    if text.find(b'/') != npos:
+        host_of(text, host)
+        return
+    cdef size_t start = text.rfind(b'@')
+    start = 0 if start == npos else start + 1
+    # IPv6 addresses are bracketed, so a port follows the last ':' after any ']'
+    cdef size_t end = text.rfind(b':')
+    if end == npos or end < start or text.find(b']', end) != npos:
+        end = text.size()
+    host.assign(text, start, end - start)
+
+cdef vector[string] psl_many(
+        hosts_or_urls, size_t extra_segments, PSL current) except *:
+    '''Return the last (tld + extra_segments) segments of each host or url.'''
+    cdef vector[string] strings = as_utf8_vector(hosts_or_urls, 'utf-8')
+    cdef vector[string] results = vector[string](strings.size())
+    cdef string host
+    cdef size_t i, failed = npos
+    with nogil:
+        for i in range(strings.size()):
+            host_of_host_or_url(strings[i], &host)
+            if host.empty():
+                continue
+            if not last_segments(
+                    host, current.tld_length(host) + extra_segments, &results[i]):
+                failed = i
+                break
+    stats_psl_looked_up(strings.size() if failed == npos else failed + 1)
+    if failed != npos:
+        raise ValueError(
+            'Empty segment in %s' % host.decode('utf-8', 'replace'))
+    return results
+
+cdef pack(vector[string]& results, bint packed):
+    '''Return results as a list, or a packed string and array of offsets.'''
+    if not packed:
+        return results
+    cdef array.array offsets = array.clone(offset_template, results.size() + 1, False)
+    cdef string data
+    cdef size_t i
+    offsets.data.as_ulongs[0] = 0
+    for i in range(results.size()):
+        data.append(results[i])
+        offsets.data.as_ulongs[i + 1] = data.size()
+    return data, offsets
+
+cdef array.array offset_template = array.array('L')
+
+cdef pack_pooled(vector[string]& results, bint packed):
+    '''Return results as pack does, sharing them through the intern pool if it's on.'''
+    if packed or not intern_pool.maxsize:
+        return pack(results, packed)
+    return [intern_pool.get(results[i], False) for i in range(results.size())]
+
+###############################################################################
+# Fingerprints
+###############################################################################
+
+# A fingerprint is the 128-bit MurmurHash3 (x64 variant, seed 0) of a url's string,
+# and the 64-bit fingerprint is its first half. With equiv, the url is first put in
+# the form that Url::equiv compares, so equivalent urls have the same fingerprint.
+cdef uint64_t MURMUR_C1 = 0x87c37b91114253d5
+cdef uint64_t MURMUR_C2 = 0x4cf5ad432745937f
+cdef uint64_t MURMUR_F1 = 0xff51afd7ed558ccd
+cdef uint64_t MURMUR_F2 = 0xc4ceb9fe1a85ec53
+
+cdef inline uint64_t read_uint64(const uint8_t* data) nogil:
+    return read_uint32(data) | (<uint64_t>read_uint32(data + 4) << 32)
+
+cdef inline uint64_t rotl64(uint64_t x, int r) nogil:
+    return (x << r) | (x >> (64 - r))
+
+cdef inline uint64_t fmix64(uint64_t k) nogil:
+    k ^= k >> 33
+    k *= MURMUR_F1
+    k ^= k >> 33
+    k *= MURMUR_F2
+    k ^= k >> 33
+    return k
+
+cdef void murmur3(const char* s, size_t length, uint64_t* result) nogil:
+    '''Set result[0] and result[1] to the two halves of the MurmurHash3 of s.'''
+    cdef const uint8_t* data = <const uint8_t*>s
+    cdef size_t remaining = length & 15
+    cdef const uint8_t* tail = data + length - remaining
+    cdef uint64_t h1 = 0, h2 = 0, k1, k2
+    cdef size_t i
+
+    while data != tail:
+        k1 = read_uint64(data) * MURMUR_C1
+        h1 ^= rotl64(k1, 31) * MURMUR_C2
+        h1 = (rotl64(h1, 27) + h2) * 5 + 0x52dce729
+        k2 = read_uint64(data + 8) * MURMUR_C2
+        h2 ^= rotl64(k2, 33) * MURMUR_C1
+        h2 = (rotl64(h2, 31) + h1) * 5 + 0x38495ab5
+        data += 16
+
+    k1 = k2 = 0
+    for i in range(remaining):
+        if i < 8:
+            k1 |= <uint64_t>tail[i] << (8 * i)
+        else:
+            k2 |= <uint64_t>tail[i] << (8 * (i - 8))
+    if remaining > 8:
+        h2 ^= rotl64(k2 * MURMUR_C2, 33) * MURMUR_C1
+    if remaining > 0:
+        h1 ^= rotl64(k1 * MURMUR_C1, 31) * MURMUR_C2
+
+    h1 ^= length
+    h2 ^= length
+    h1 += h2
+    h2 += h1
+    h1 = fmix64(h1)
+    h2 = fmix64(h2)
+    h1 += h2
+    h2 += h1
+    result[0] = h1
+    result[1] = h2
+
+cdef int fingerprint(const Url& url, bint equiv, uint64_t* result) nogil except -1:
+    '''Set result to the two halves of the fingerprint of url.'''
+    cdef Url* canonical
+    cdef string serialized
+    if not equiv:
+        serialized = url.str()
+        murmur3(serialized.data(), serialized.size(), result)
+        return 0
+    # The same normalization that Url::equiv applies to both urls
+    canonical = new Url(url)
+    try:
+        canonical.strip().sort_query().defrag().deuserinfo().abspath().escape(False)
+        canonical.punycode().remove_default_port()
+        serialized = canonical.str()
+        murmur3(serialized.data(), serialized.size(), result)
+    finally:
+        del canonical
+    return 0
+
+cdef check_bits(bits):
+    if bits != 64 and bits != 128:
+        raise ValueError('Fingerprints must be 64 or 128 bits, not %s' % bits)
+
+def fingerprint_many(urls, equiv=True, bits=64, encoding='utf-8'):
+    '''
+    Return an array('Q') of the fingerprints of each of the provided url strings,
+    as URL.fingerprint would. 128-bit fingerprints take two entries each, the first
+    of which is the 64-bit fingerprint.
+    '''
+    cdef uint64_t started = stats_start()
+    check_bits(bits)
+    cdef bint canonical = equiv
+    cdef vector[string] strings = as_utf8_vector(urls, encoding)
+    cdef size_t width = bits // 64
+    cdef array.array result = array.clone(
+        fingerprint_template, strings.size() * width, False)
+    cdef uint64_t* data = <uint64_t*>result.data.as_voidptr
+    cdef uint64_t halves[2]
+    cdef Url* url = NULL
+    cdef size_t i
+    try:
+        with nogil:
+            for i in range(strings.size()):
+                url = new Url(strings[i])
+                fingerprint(dereference(url), canonical, halves)
+                del url
+                url = NULL
+                data[i * width] = halves[0]
+                if width == 2:
+                    data[i * width + 1] = halves[1]
+    finally:
+        del url
+    stats_stop(STATS_FINGERPRINT_MANY, started)
+    return result
+
+cdef array.array fingerprint_template = array.array('Q')
 
 cdef as_bytes(obj):
     if isinstance(obj, text_type):
         return obj.encode('utf-8')
     return obj
 
+###############################################################################
+# Parameter filters
+###############################################################################
+
+cdef bint glob_match(const char* pattern, size_t pattern_length,
+                     const char* s, size_t length) nogil:
+    '''Return true if s matches pattern, in which '*' and '?' are wildcards.'''
+    cdef size_t p = 0, i = 0
+    # Where to resume after the most recent '*', if the rest fails to match
+    cdef size_t star = npos, resume = 0
+    while i < length:
+        if p < pattern_length and (pattern[p] == b'?' or pattern[p] == s[i]):
+            p += 1
+            i += 1
+        elif p < pattern_length and pattern[p] == b'*':
+            star = p
+            p += 1
+            resume = i
+        elif star != npos:
+            p = star + 1
+            resume += 1
+            i = resume
+        else:
+            return False
+    while p < pattern_length and pattern[p] == b'*':
+        p += 1
+    return p == pattern_length
+
+# std::regex matches recursively, and can exhaust the stack on long inputs, so names
+# and values longer than this are never checked against the regular expressions
+cdef size_t REGEX_MAX_LENGTH = 1024
+
+# The rules of a ParamFilter, kept in a C++ class so that a Pipeline can hold its own
+# copy, and so that ParamFilter's is constructed and destroyed along with it
+cdef cppclass ParamRules:
+    unordered_set[string] names
+    vector[string] prefixes
+    vector[string] globs
+    vector[regex] patterns
+    vector[regex] values
+    bint empty
+
+cdef int param_removed(
+        const ParamRules& rules, string& name, bint has_value, const char* value,
+        size_t length) nogil except -1:
+    '''
+    Return 1 if the parameter should be removed. name is lowercased. has_value is
+    False for a parameter without an '=', like 'flag' in '?flag&a=1'.
+    '''
+    cdef size_t i
+    if rules.empty and has_value and length == 0:
+        return 1
+    for i in range(name.size()):
+        if b'A' <= name[i] <= b'Z':
+            name[i] += 32
+    if not rules.names.empty() and rules.names.count(name):
+        return 1
+    for i in range(rules.prefixes.size()):
+        if name.compare(0, rules.prefixes[i].size(), rules.prefixes[i]) == 0:
+            return 1
+    for i in range(rules.globs.size()):
+        if glob_match(rules.globs[i].data(), rules.globs[i].size(),
+                      name.data(), name.size()):
+            return 1
+    if name.size() <= REGEX_MAX_LENGTH:
+        for i in range(rules.patterns.size()):
+            if regex_search(name, rules.patterns[i]):
+                return 1
+    if length <= REGEX_MAX_LENGTH:
+        for i in range(rules.values.size()):
+            if regex_search(value, value + length, rules.values[i]):
+                return 1
+    return 0
+
+cdef int filter_param_string(
+        const ParamRules& rules, const string& s, char separator, string* result
+        ) nogil except -1:
+    '''Set result to s without the parameters to remove, as Url::deparam does.'''
+    cdef size_t start = 0, end, position
+    cdef const char* data = s.data()
+    cdef string name
+    result.clear()
+    while start < s.size():
+        end = s.find(separator, start)
+        if end == npos:
+            end = s.size()
+        position = s.find(b'=', start)
+        if position == npos or position > end:
+            position = end
+        name.assign(s, start, position - start)
+        if not param_removed(
+                rules, name, position < end, data + position + 1,
+                end - position - 1 if position < end else 0):
+            if not result.empty():
+                result.push_back(separator)
+            result.append(s, start, end - start)
+        start = end + 1
+    return 0
+
+cdef int filter_params(const ParamRules& rules, Url* url) nogil except -1:
+    '''Remove the parameters to remove from the query and params of url.'''
+    cdef string result
+    filter_param_string(rules, url.query(), b'&', &result)
+    url.setQuery(result)
+    filter_param_string(rules, url.params(), b';', &result)
+    url.setParams(result)
+    return 0
+
+cdef ParamRules deparam_rules(params) except *:
+    '''Return the rules for deparam(params), with params a ParamFilter or names.'''
+    if isinstance(params, ParamFilter):
+        return (<ParamFilter>params).rules
+    cdef ParamRules rules
+    rules.empty = False
+    for param in params:
+        rules.names.insert(as_bytes(param.lower()))
+    return rules
+
+cdef class ParamFilter:
+    '''
+    A compiled set of rules for parameters to remove, for use with filter_params.
+
+    A parameter is removed if its name (compared case-insensitively) is one of names,
+    starts with one of prefixes, matches one of the globs ('*' and '?' wildcards) or
+    contains a match for one of the patterns (ECMAScript regular expressions). It's
+    also removed if its value contains a match for one of the values patterns, or
+    with empty, if it has an empty value ('a=', but not a bare 'a'). Names and values
+    longer than 1024 bytes are never matched against patterns or values.
+    '''
+
+    cdef ParamRules rules
+
+    def __init__(self, names=(), prefixes=(), globs=(), patterns=(), values=(),
+                 empty=False):
+        self.rules.names.clear()
+        self.rules.prefixes.clear()
+        self.rules.globs.clear()
+        self.rules.patterns.clear()
+        self.rules.values.clear()
+        for name in names:
+            self.rules.names.insert(as_bytes(name.lower()))
+        for prefix in prefixes:
+            self.rules.prefixes.push_back(as_bytes(prefix.lower()))
+        for glob in globs:
+            self.rules.globs.push_back(as_bytes(glob.lower()))
+        cdef int flags = ECMAScript | nosubs | optimize
+        for pattern in patterns:
+            self.rules.patterns.push_back(
+                regex(<string>as_bytes(pattern), <syntax_option_type>(flags | icase)))
+        for pattern in values:
+            self.rules.values.push_back(
+                regex(<string>as_bytes(pattern), <syntax_option_type>flags))
+        self.rules.empty = empty
+
+cdef class ParamSet(ParamFilter):
+    '''
+    A set of parameter names to remove, built once for use with deparam. Entries that
+    end in '*', like 'utm_*', remove every parameter starting with the rest.
+    '''
+
+    def __init__(self, params):
+        names, prefixes = [], []
+        for param in params:
+            if param.endswith('*' if isinstance(param, text_type) else b'*'):
+                prefixes.append(param[:-1])
+            else:
+                names.append(param)
+        ParamFilter.__init__(self, names=names, prefixes=prefixes)
+
+###############################################################################
+# Serialization
+###############################################################################
+
+# URLs are serialized without needing to be parsed again, as a version byte followed
+# by one record for each url (preceded by the count of urls for dumps_many). Each
+# record is:
+#
+#   flags                     1 if the url has params, 2 if it has a query
+#   port                      varint
+#   scheme, userinfo, host, path, params, query, fragment
+#                             each a varint length followed by that many bytes
+#
+# Varints are unsigned LEB128. Url only lets a query (or params) be present but empty
+# when it's parsed, so those urls are rebuilt starting from ';', '?' or ';?'.
+DUMP_VERSION = 1
+cdef uint8_t HAS_PARAMS = 1
+cdef uint8_t HAS_QUERY = 2
+
+cdef inline void append_varint(string* result, uint64_t value) nogil:
+    while value >= 0x80:
+        result.push_back(<char>((value & 0x7f) | 0x80))
+        value >>= 7
+    result.push_back(<char>value)
+
+cdef inline bint read_varint(
+        const uint8_t* data, size_t size, size_t* position, uint64_t* result) nogil:
+    '''Read a varint at position, advancing past it. Returns false if truncated.'''
+    cdef int shift = 0
+    result[0] = 0
+    while position[0] < size and shift < 64:
+        result[0] |= <uint64_t>(data[position[0]] & 0x7f) << shift
+        position[0] += 1
+        if not data[position[0] - 1] & 0x80:
+            return True
+        shift += 7
+    return False
+
+cdef inline void append_component(string* result, const string& component) nogil:
+    append_varint(result, component.size())
+    result.append(component)
+
+cdef uint8_t url_flags(const Url& url) nogil:
+    '''Return the flags for url, including params and queries that are empty.'''
+    cdef uint8_t flags = 0
+    cdef Url* probe
+    if not url.params().empty():
+        flags |= HAS_PARAMS
+    if not url.query().empty():
+        flags |= HAS_QUERY
+    if flags == HAS_PARAMS | HAS_QUERY:
+        return flags
+    # Setting them again makes the flags match whether they're empty, so the url is
+    # unchanged unless one of them is present but empty
+    probe = new Url(url)
+    try:
+        probe.setParams(url.params()).setQuery(url.query())
+        if dereference(probe) == url:
+            return flags
+        probe.assign(url).setParams(url.params())
+        if not (dereference(probe) == url):
+            flags |= HAS_PARAMS
+        probe.assign(url).setQuery(url.query())
+        if not (dereference(probe) == url):
+            flags |= HAS_QUERY
+    finally:
+        del probe
+    return flags
+
+cdef void dump_url(const Url& url, string* result) nogil:
+    '''Append the record for url to result.'''
+    result.push_back(<char>url_flags(url))
+    append_varint(result, url.port())
+    append_component(result, url.scheme())
+    append_component(result, url.userinfo())
+    append_component(result, url.host())
+    append_component(result, url.path())
+    append_component(result, url.params())
+    append_component(result, url.query())
+    append_component(result, url.fragment())
+
+cdef string seeds[4]
+seeds[0] = b''
+seeds[HAS_PARAMS] = b';'
+seeds[HAS_QUERY] = b'?'
+seeds[HAS_PARAMS | HAS_QUERY] = b';?'
+
+cdef int load_url(
+        const uint8_t* data, size_t size, size_t* position, Url** result) nogil except -1:
+    '''Set result to the url from the record at position, returning 0 if truncated.'''
+    cdef uint8_t flags
+    cdef uint64_t port, length
+    cdef string components[7]
+    cdef size_t i
+    if position[0] >= size:
+        return 0
+    flags = data[position[0]]
+    position[0] += 1
+    if flags > (HAS_PARAMS | HAS_QUERY) or not read_varint(data, size, position, &port):
+        return 0
+    if port > 65535:
+        return 0
+    for i in range(7):
+        if not read_varint(data, size, position, &length) or length > size - position[0]:
+            return 0
+        components[i].assign(<const char*>data + position[0], length)
+        position[0] += length
+
+    cdef Url* url = new Url(seeds[flags])
+    result[0] = url
+    url.setPort(port)
+    url.setScheme(components[0])
+    url.setUserinfo(components[1])
+    url.setHost(components[2])
+    url.setPath(components[3])
+    if not components[4].empty():
+        url.setParams(components[4])
+    if not components[5].empty():
+        url.setQuery(components[5])
+    url.setFragment(components[6])
+    return 1
+
+cdef string dump_header(size_t count, bint many):
+    cdef string result
+    result.push_back(<char>DUMP_VERSION)
+    if many:
+        append_varint(&result, count)
+    return result
+
+cdef size_t check_header(const uint8_t[::1] data) except? 0:
+    '''Return where the records in data begin.'''
+    if data.shape[0] == 0 or data[0] != DUMP_VERSION:
+        raise ValueError('Not a serialized URL, or an unsupported version.')
+    return 1
+
+def dumps(url):
+    '''Return a compact binary serialization of a URL, which loads rebuilds.'''
+    cdef Url* ptr = (<StringURL?>url).ptr
+    cdef string result = dump_header(1, False)
+    with nogil:
+        dump_url(dereference(ptr), &result)
+    return <bytes>result
+
+def loads(data, cls=None):
+    '''Return the URL (of class cls, by default URL) serialized in data.'''
+    cdef list result = load_many(data, cls, False)
+    return result[0]
+
+def dumps_many(urls):
+    '''Return a compact binary serialization of many URLs, which loads_many rebuilds.'''
+    cdef list objects = list(urls)
+    cdef vector[Url*] ptrs
+    ptrs.reserve(len(objects))
+    for url in objects:
+        ptrs.push_back((<StringURL?>url).ptr)
+    cdef string result = dump_header(ptrs.size(), True)
+    cdef size_t i
+    with nogil:
+        for i in range(ptrs.size()):
+            dump_url(dereference(ptrs[i]), &result)
+    return <bytes>result
+
+def loads_many(data, cls=None):
+    '''Return the list of URLs (of class cls, by default URL) serialized in data.'''
+    return load_many(data, cls, True)
+
+cdef list load_many(data, cls, bint many):
+    # The records are read forward from a pointer to the first byte
+    if not memoryview(data).c_contiguous:
+        raise ValueError('Serialized URLs are not in a contiguous buffer.')
+    cdef const uint8_t[::1] view = data
+    cdef const uint8_t* buffer = &view[0] if view.shape[0] else NULL
+    cdef size_t size = view.shape[0]
+    cdef size_t position = check_header(view)
+    cdef uint64_t count = 1
+    if many and not read_varint(buffer, size, &position, &count):
+        raise ValueError('Serialized URLs are truncated or corrupt.')
+    # Every record takes at least 9 bytes
+    if count > (size - position) // 9:
+        raise ValueError('Serialized URLs are truncated or corrupt.')
+
+    cdef vector[Url*] parsed
+    cdef Url* url = NULL
+    cdef size_t i
+    parsed.reserve(count)
+    try:
+        with nogil:
+            for i in range(count):
+                if not load_url(buffer, size, &position, &url):
+                    break
+                parsed.push_back(url)
+        if parsed.size() != count or position != size:
+            raise ValueError('Serialized URLs are truncated or corrupt.')
+    except:
+        for i in range(parsed.size()):
+            del parsed[i]
+        raise
+
+    if cls is None:
+        cls = URL
+    cdef list result = []
+    cdef StringURL obj
+    for i in range(parsed.size()):
+        obj = cls.__new__(cls, unparsed)
+        obj.ptr = parsed[i]
+        result.append(obj)
+    return result
+
 cdef class StringURL:
-    '''Wrapper around url-cpp, which deals in strings.'''
+    '''
+    Wrapper around url-cpp, which deals in strings.
+
+    The GIL is released while url-cpp does its work, so distinct instances may be
+    used from many threads at once. A single instance must not be used from one
+    thread while another thread is modifying it.
+    '''
 
     cdef Url *ptr
+    # Set when ptr is shared with copies of this url, and owns it. The first of them
+    # to be modified gets a Url of its own.
+    cdef shared_ptr[Url] shared
+    # The serialized url, built on demand and dropped whenever the url changes
+    cdef bytes serialized
 
     parse = classmethod(ParseMethod)
+    parse_many = classmethod(ParseManyMethod)
+    try_parse = classmethod(TryParseMethod)
+    try_parse_many = classmethod(TryParseManyMethod)
 
-    def __cinit__(self, const string& s):
-        self.ptr = new Url(s)
+    def __cinit__(self, s):
+        cdef string c_s
+        cdef uint64_t started
+        if s is not unparsed:
+            c_s = s
+            started = stats_start()
+            try:
+                with nogil:
+                    self.ptr = new Url(c_s)
+            except ValueError:
+                stats_parse_failed(c_s, PARSE_OK)
+                raise
+            stats_stop(STATS_PARSE, started)
 
     def __dealloc__(self):
-        del self.ptr
+        if not self.shared:
+            del self.ptr
 
     property scheme:
         def __get__(self):
-            return self.ptr.scheme()
+            return pooled(self.ptr.scheme(), False)
         def __set__(self, s):
+            self.changed()
             self.ptr.setScheme(as_bytes(s))
 
     property host:
         def __get__(self):
-            return self.ptr.host()
+            return pooled(self.ptr.host(), False)
         def __set__(self, s):
+            self.changed()
             self.ptr.setHost(as_bytes(s))
 
     property port:
         def __get__(self):
             return self.ptr.port()
         def __set__(self, i):
+            self.changed()
             self.ptr.setPort(i)
 
     property path:
         def __get__(self):
             return self.ptr.path()
         def __set__(self, s):
+            self.changed()
             self.ptr.setPath(as_bytes(s))
 
     property params:
         def __get__(self):
             return self.ptr.params()
         def __set__(self, s):
+            self.changed()
             self.ptr.setParams(as_bytes(s))
 
     property query:
         def __get__(self):
             return self.ptr.query()
         def __set__(self, s):
+            self.changed()
             self.ptr.setQuery(as_bytes(s))
 
     property fragment:
         def __get__(self):
             return self.ptr.fragment()
         def __set__(self, s):
+            self.changed()
             self.ptr.setFragment(as_bytes(s))
 
     property userinfo:
         def __get__(self):
             return self.ptr.userinfo()
         def __set__(self, s):
+            self.changed()
             self.ptr.setUserinfo(as_bytes(s))
 
     def copy(self):
-        '''Return a new instance of an identical URL.'''
-        new = StringURL(b'')
-        new.ptr.assign(dereference(self.ptr));
+        '''
+        Return a new instance of an identical URL. The two share their Url until one of
+        them is modified.
+        '''
+        cdef uint64_t started = stats_start()
+        cdef StringURL new = type(self).__new__(type(self), unparsed)
+        if not self.shared:
+            self.shared.reset(self.ptr)
+        new.shared = self.shared
+        new.ptr = self.ptr
+        new.serialized = self.serialized
+        stats_stop(STATS_COPY, started)
         return new
 
     def equiv(self, other, encoding='utf-8'):
         '''Return true if this url is equivalent to another'''
+        cdef uint64_t started = stats_start()
         if isinstance(other, basestring):
-            return self.equiv(self.parse(other, encoding))
-        return self.ptr.equiv(dereference((<StringURL?>other).ptr))
+            other = self.parse(other, encoding)
+        cdef Url* other_ptr = (<StringURL?>other).ptr
+        cdef bool result
+        with nogil:
+            result = self.ptr.equiv(dereference(other_ptr))
+        stats_stop(STATS_EQUIV, started)
+        return result
+
+    def fingerprint(self, equiv=True, bits=64):
+        '''
+        Return a 64 or 128-bit hash of this url. With equiv, urls that are equivalent
+        have the same fingerprint, and otherwise, urls that are equal do.
+        '''
+        cdef uint64_t started = stats_start()
+        check_bits(bits)
+        cdef bint canonical = equiv
+        cdef uint64_t halves[2]
+        if not canonical:
+            self.hash_serialized(halves)
+        else:
+            with nogil:
+                fingerprint(dereference(self.ptr), True, halves)
+        stats_stop(STATS_FINGERPRINT, started)
+        if bits == 64:
+            return halves[0]
+        return (<object>halves[1] << 64) | halves[0]
+
+    def __hash__(self):
+        cdef uint64_t started = stats_start()
+        cdef uint64_t halves[2]
+        self.hash_serialized(halves)
+        stats_stop(STATS_HASH, started)
+        cdef Py_hash_t result = <Py_hash_t>halves[0]
+        # -1 is reserved to signal errors
+        return -2 if result == -1 else result
+
+    cdef int hash_serialized(self, uint64_t* result) except -1:
+        '''Set result to the two halves of the plain fingerprint of this url.'''
+        cdef bytes serialized = self.serialize()
+        cdef const char* data = serialized
+        cdef size_t length = len(serialized)
+        with nogil:
+            murmur3(data, length, result)
+        return 0
+
+    def surt(self, psl=None):
+        '''
+        Return the SURT form of this url, for keys that sort by host and then path: the
+        host with its segments reversed and without a leading www (as found with psl,
+        or else the default PSL), the port if it's not the default, and then the path,
+        params and sorted query, all lowercased.
+        '''
+        cdef uint64_t started = stats_start()
+        cdef PSL current = chosen_psl(psl)
+        cdef Url* url = new Url(dereference(self.ptr))
+        cdef string result
+        try:
+            with nogil:
+                surt(url, current, &result)
+        finally:
+            del url
+        stats_stop(STATS_SURT, started)
+        return <bytes>result
+
+    def __reduce__(self):
+        return loads, (dumps(self), type(self))
+
+    def __getbuffer__(self, Py_buffer* view, int flags):
+        # The view holds its own reference to the serialized url, so that changing
+        # the url while it's exported leaves the view as it was
+        cdef bytes serialized = self.serialize()
+        PyBuffer_FillInfo(view, self, <char*>serialized, len(serialized), 1, flags)
+        Py_INCREF(serialized)
+        view.internal = <void*>serialized
+
+    def __releasebuffer__(self, Py_buffer* view):
+        Py_DECREF(<object>view.internal)
 
     def __richcmp__(self, other, op):
         '''Return true if this url is /exactly/ equal to another'''
@@ -124,32 +1702,68 @@ cdef class StringURL:
         return '<url.URL object "%s" >' % str(self)
 
     def canonical(self):
-        self.ptr.sort_query()
+        '''Put queries and params in sorted order'''
+        cdef uint64_t started = stats_start()
+        self.changed()
+        with nogil:
+            self.ptr.sort_query()
+        stats_stop(STATS_CANONICAL, started)
         return self
 
     def defrag(self):
         '''Remove the fragment from this url'''
+        cdef uint64_t started = stats_start()
+        self.changed()
         self.ptr.defrag()
+        stats_stop(STATS_DEFRAG, started)
         return self
 
     def deparam(self, params):
-        '''Strip any of the provided parameters out of the url'''
-        lowered = unordered_set[string](as_bytes(p.lower()) for p in params)
-        self.ptr.deparam(lowered)
+        '''
+        Strip any of the provided parameters out of the url. params may also be a
+        ParamSet (or any ParamFilter), which is used without any conversion.
+        '''
+        cdef uint64_t started = stats_start()
+        self.changed()
+        if isinstance(params, ParamFilter):
+            with nogil:
+                filter_params((<ParamFilter>params).rules, self.ptr)
+            stats_stop(STATS_DEPARAM, started)
+            return self
+
+        cdef ParamRules rules = deparam_rules(params)
+        with nogil:
+            filter_params(rules, self.ptr)
+        stats_stop(STATS_DEPARAM, started)
         return self
 
     def filter_params(self, function):
-        '''Remove parameters if function(name, value), name and value are bytes.'''
+        '''
+        Remove parameters if function(name, value), name and value are bytes. function
+        may also be a ParamFilter, which runs without calling back into Python.
+        '''
+        cdef uint64_t started = stats_start()
+        self.changed()
+        if isinstance(function, ParamFilter):
+            with nogil:
+                filter_params((<ParamFilter>function).rules, self.ptr)
+            stats_stop(STATS_FILTER_PARAMS, started)
+            return self
+
         def keep(query):
             name, _, value = query.partition('=')
             return not function(name, value)
         self.query = '&'.join(q for q in self.query.split('&') if q and keep(q))
         self.params = ';'.join(q for q in self.params.split(';') if q and keep(q))
+        stats_stop(STATS_FILTER_PARAMS, started)
         return self
 
     def deuserinfo(self):
         '''Remove any userinfo'''
+        cdef uint64_t started = stats_start()
+        self.changed()
         self.ptr.deuserinfo()
+        stats_stop(STATS_DEUSERINFO, started)
         return self
 
     def strip(self):
@@ -157,12 +1771,19 @@ cdef class StringURL:
         Strip semantically meaningless excess '?', '&', and ';' characters from query
         and params.
         '''
+        cdef uint64_t started = stats_start()
+        self.changed()
         self.ptr.strip()
+        stats_stop(STATS_STRIP, started)
         return self
 
     def abspath(self):
         '''Clear out any '..' and excessive slashes from the path'''
-        self.ptr.abspath()
+        cdef uint64_t started = stats_start()
+        self.changed()
+        with nogil:
+            self.ptr.abspath()
+        stats_stop(STATS_ABSPATH, started)
         return self
 
     def relative(self, other):
@@ -174,50 +1795,91 @@ cdef class StringURL:
 
     def relative_to(self, base):
         '''Evaluate the new path relative to the current url'''
-        if isinstance(base, bytes):
-            self.ptr.relative_to(<string>base)
-        elif isinstance(base, unicode):
-            self.ptr.relative_to(<string>(base.encode('utf-8')))
+        cdef uint64_t started = stats_start()
+        cdef string base_string
+        cdef Url* base_ptr
+        self.changed()
+        if isinstance(base, bytes) or isinstance(base, unicode):
+            base_string = as_bytes(base)
+            with nogil:
+                self.ptr.relative_to(base_string).abspath()
         else:
-            self.ptr.relative_to(<const Url&>dereference((<StringURL?>base).ptr))
-        self.ptr.abspath()
+            base_ptr = (<StringURL?>base).ptr
+            with nogil:
+                self.ptr.relative_to(<const Url&>dereference(base_ptr)).abspath()
+        stats_stop(STATS_RELATIVE_TO, started)
         return self
 
     def sanitize(self):
         '''A shortcut to abspath and escape'''
-        self.ptr.abspath().escape(False)
+        cdef uint64_t started = stats_start()
+        self.changed()
+        with nogil:
+            self.ptr.abspath().escape(False)
+        stats_stop(STATS_SANITIZE, started)
         return self
 
     def remove_default_port(self):
         '''If a port is provided and is the default, remove it.'''
+        cdef uint64_t started = stats_start()
+        self.changed()
         self.ptr.remove_default_port()
+        stats_stop(STATS_REMOVE_DEFAULT_PORT, started)
         return self
 
     def escape(self, strict=False):
         '''Make sure that the path is correctly escaped'''
-        self.ptr.escape(<bool>strict)
+        cdef uint64_t started = stats_start()
+        cdef bool c_strict = strict
+        self.changed()
+        with nogil:
+            self.ptr.escape(c_strict)
+        stats_stop(STATS_ESCAPE, started)
         return self
 
     def unescape(self):
         '''Replace entities with their corresponding byte values'''
-        self.ptr.unescape()
+        cdef uint64_t started = stats_start()
+        self.changed()
+        with nogil:
+            self.ptr.unescape()
+        stats_stop(STATS_UNESCAPE, started)
         return self
 
     def encode(self, encoding):
         '''Return the url in an arbitrary encoding'''
+        cdef uint64_t started = stats_start()
         if encoding == 'utf-8' or encoding == 'utf8':
-            return self.ptr.str()
+            result = self.serialize()
         else:
-            return self.ptr.str().decode('utf-8').encode(encoding)
+            result = self.serialize().decode('utf-8').encode(encoding)
+        stats_stop(STATS_ENCODE, started)
+        return result
 
     def punycode(self):
         '''Convert to punycode hostname'''
-        self.ptr.punycode()
+        cdef uint64_t started = stats_start()
+        self.changed()
+        try:
+            with nogil:
+                self.ptr.punycode()
+        except ValueError:
+            stats_punycode_failed()
+            raise
+        stats_stop(STATS_PUNYCODE, started)
         return self
 
     def unpunycode(self):
         '''Convert to an unpunycoded hostname'''
-        self.ptr.unpunycode()
+        cdef uint64_t started = stats_start()
+        self.changed()
+        try:
+            with nogil:
+                self.ptr.unpunycode()
+        except ValueError:
+            stats_punycode_failed()
+            raise
+        stats_stop(STATS_UNPUNYCODE, started)
         return self
 
     ###########################################################################
@@ -231,16 +1893,18 @@ cdef class StringURL:
         '''Return the 'pay-level domain' of the url
             (http://moz.com/blog/what-the-heck-should-we-call-domaincom)'''
         def __get__(self):
-            if not self.ptr.host().empty():
-                return psl.getPLD(self.ptr.host())
-            return b''
+            cdef uint64_t started = stats_start()
+            result = find_pld(chosen_psl(None), self.ptr.host())
+            stats_stop(STATS_PLD, started)
+            return result
 
     property tld:
         '''Return the top-level domain of a url'''
         def __get__(self):
-            if not self.ptr.host().empty():
-                return psl.getTLD(self.ptr.host())
-            return b''
+            cdef uint64_t started = stats_start()
+            result = find_tld(chosen_psl(None), self.ptr.host())
+            stats_stop(STATS_TLD, started)
+            return result
 
     property absolute:
         '''Return True if this is a fully-qualified URL with a hostname and everything'''
@@ -252,72 +1916,1444 @@ cdef class StringURL:
     property unicode:
         '''Return a unicode version of this url'''
         def __get__(self):
-            return self.ptr.str().decode('utf-8')
+            cdef uint64_t started = stats_start()
+            result = self.serialize().decode('utf-8')
+            stats_stop(STATS_UNICODE, started)
+            return result
 
     property utf8:
         '''Return a utf-8 version of this url'''
         def __get__(self):
-            return self.ptr.str()
+            cdef uint64_t started = stats_start()
+            result = self.serialize()
+            stats_stop(STATS_UTF8, started)
+            return result
+
+    cdef void changed(self):
+        '''
+        Forget anything cached about this url, which is about to be modified, and make
+        sure that it's not sharing its Url with any copies.
+        '''
+        self.serialized = None
+        if self.shared and self.shared.use_count() > 1:
+            self.ptr = new Url(dereference(self.ptr))
+            self.shared.reset()
 
+    cdef bytes serialize(self):
+        '''Return the serialized url, building it only if it has changed.'''
+        cdef string result
+        if self.serialized is None:
+            with nogil:
+                result = self.ptr.str()
+            self.serialized = result
+        return self.serialized
+
+
+cdef enum DecodedComponent:
+    DECODED_SCHEME
+    DECODED_HOST
+    DECODED_PATH
+    DECODED_PARAMS
+    DECODED_QUERY
+    DECODED_FRAGMENT
+    DECODED_USERINFO
+    DECODED_PLD
+    DECODED_TLD
+    DECODED_URL
+    DECODED_COMPONENTS
+
+cdef unicode decode(const string& s):
+    '''Return s decoded as utf-8, skipping the decoder if it's all ascii.'''
+    cdef const char* data = s.data()
+    cdef size_t i
+    for i in range(s.size()):
+        if <unsigned char>data[i] >= 0x80:
+            return PyUnicode_DecodeUTF8(data, s.size(), NULL)
+    return PyUnicode_DecodeLatin1(data, s.size(), NULL)
 
 cdef class UnicodeURL(StringURL):
     '''A version of the URL class that deals in Unicode.'''
+
+    # Components decoded on demand, indexed by DecodedComponent, and dropped whenever
+    # the url changes
+    cdef list decoded
+    # The PSL that the decoded pld and tld came from
+    cdef object decoded_psl
+
+    cdef void changed(self):
+        StringURL.changed(self)
+        self.decoded = None
+
+    cdef unicode decoded_component(self, DecodedComponent which):
+        '''Return a decoded component of this url, decoding it only if it's changed.'''
+        cdef PSL current
+        if self.decoded is None:
+            self.decoded = [None] * DECODED_COMPONENTS
+        elif (which == DECODED_PLD or which == DECODED_TLD) and self.decoded_psl is not psl:
+            self.decoded[DECODED_PLD] = self.decoded[DECODED_TLD] = None
+        result = self.decoded[which]
+        if result is None:
+            if which == DECODED_SCHEME:
+                result = pooled(self.ptr.scheme(), True)
+            elif which == DECODED_HOST:
+                result = pooled(self.ptr.host(), True)
+            elif which == DECODED_PATH:
+                result = decode(self.ptr.path())
+            elif which == DECODED_PARAMS:
+                result = decode(self.ptr.params())
+            elif which == DECODED_QUERY:
+                result = decode(self.ptr.query())
+            elif which == DECODED_FRAGMENT:
+                result = decode(self.ptr.fragment())
+            elif which == DECODED_USERINFO:
+                result = decode(self.ptr.userinfo())
+            elif which == DECODED_URL:
+                result = self.serialize().decode('utf-8')
+            else:
+                current = chosen_psl(None)
+                self.decoded_psl = current
+                if which == DECODED_PLD:
+                    result = pooled(find_pld(current, self.ptr.host()), True)
+                else:
+                    result = pooled(find_tld(current, self.ptr.host()), True)
+            self.decoded[which] = result
+        return result
+
     property scheme:
         def __get__(self):
-            return text_type(self.ptr.scheme(), encoding='utf-8')
+            return self.decoded_component(DECODED_SCHEME)
         def __set__(self, s):
+            self.changed()
             self.ptr.setScheme(as_bytes(s))
 
     property host:
         def __get__(self):
-            return text_type(self.ptr.host(), encoding='utf-8')
+            return self.decoded_component(DECODED_HOST)
         def __set__(self, s):
+            self.changed()
             self.ptr.setHost(as_bytes(s))
 
     property path:
         def __get__(self):
-            return text_type(self.ptr.path(), encoding='utf-8')
+            return self.decoded_component(DECODED_PATH)
         def __set__(self, s):
+            self.changed()
             self.ptr.setPath(as_bytes(s))
 
     property params:
         def __get__(self):
-            return text_type(self.ptr.params(), encoding='utf-8')
+            return self.decoded_component(DECODED_PARAMS)
         def __set__(self, s):
+            self.changed()
             self.ptr.setParams(as_bytes(s))
 
     property query:
         def __get__(self):
-            return text_type(self.ptr.query(), encoding='utf-8')
+            return self.decoded_component(DECODED_QUERY)
         def __set__(self, s):
+            self.changed()
             self.ptr.setQuery(as_bytes(s))
 
     property fragment:
         def __get__(self):
-            return text_type(self.ptr.fragment(), encoding='utf-8')
+            return self.decoded_component(DECODED_FRAGMENT)
         def __set__(self, s):
+            self.changed()
             self.ptr.setFragment(as_bytes(s))
 
     property userinfo:
         def __get__(self):
-            return text_type(self.ptr.userinfo(), encoding='utf-8')
+            return self.decoded_component(DECODED_USERINFO)
         def __set__(self, s):
+            self.changed()
             self.ptr.setUserinfo(as_bytes(s))
 
     property pld:
         '''Return the 'pay-level domain' of the url
             (http://moz.com/blog/what-the-heck-should-we-call-domaincom)'''
         def __get__(self):
-            if not self.ptr.host().empty():
-                return psl.getPLD(self.ptr.host()).decode('utf-8')
-            return u''
+            cdef uint64_t started = stats_start()
+            result = self.decoded_component(DECODED_PLD)
+            stats_stop(STATS_PLD, started)
+            return result
 
     property tld:
         '''Return the top-level domain of a url'''
         def __get__(self):
-            if not self.ptr.host().empty():
-                return psl.getTLD(self.ptr.host()).decode('utf-8')
-            return u''
+            cdef uint64_t started = stats_start()
+            result = self.decoded_component(DECODED_TLD)
+            stats_stop(STATS_TLD, started)
+            return result
+
+    property unicode:
+        '''Return a unicode version of this url'''
+        def __get__(self):
+            cdef uint64_t started = stats_start()
+            result = self.decoded_component(DECODED_URL)
+            stats_stop(STATS_UNICODE, started)
+            return result
 
     def __str__(self):
-        return self.unicode
+        return self.decoded_component(DECODED_URL)
+
+
+cdef enum Operation:
+    STRIP
+    ABSPATH
+    ESCAPE
+    ESCAPE_STRICT
+    UNESCAPE
+    CANONICAL
+    DEFRAG
+    DEPARAM
+    DEUSERINFO
+    PUNYCODE
+    UNPUNYCODE
+    REMOVE_DEFAULT_PORT
+    SANITIZE
+
+
+cdef dict operations = {
+    'strip': STRIP,
+    'abspath': ABSPATH,
+    'escape': ESCAPE,
+    'unescape': UNESCAPE,
+    'canonical': CANONICAL,
+    'defrag': DEFRAG,
+    'deparam': DEPARAM,
+    'filter_params': DEPARAM,
+    'deuserinfo': DEUSERINFO,
+    'punycode': PUNYCODE,
+    'unpunycode': UNPUNYCODE,
+    'remove_default_port': REMOVE_DEFAULT_PORT,
+    'sanitize': SANITIZE
+}
+
+
+cdef class Pipeline:
+    '''
+    A fixed sequence of URL operations, applied to many url strings at once.
+
+    Each operation is either the name of a chainable URL method, or a tuple of the
+    name and its argument, e.g. ('deparam', ['utm_source']), ('escape', True) or
+    ('filter_params', ParamFilter(...)).
+    '''
+
+    cdef vector[Operation] operations
+    cdef vector[ParamRules] blacklists
+
+    def __cinit__(self, steps):
+        cdef Operation operation
+        for step in steps:
+            if isinstance(step, tuple):
+                name, argument = step
+            else:
+                name, argument = step, None
+            if name not in operations:
+                raise ValueError('Unknown operation: %s' % name)
+            operation = operations[name]
+            if operation == DEPARAM:
+                if name == 'filter_params' and not isinstance(argument, ParamFilter):
+                    raise ValueError('filter_params takes a ParamFilter')
+                self.blacklists.push_back(deparam_rules(argument))
+            elif operation == ESCAPE:
+                if argument:
+                    operation = ESCAPE_STRICT
+            elif isinstance(step, tuple):
+                raise ValueError('%s takes no argument' % name)
+            self.operations.push_back(operation)
+
+    cdef int run(self, Url* url) nogil except -1:
+        cdef size_t blacklist = 0
+        for operation in self.operations:
+            if operation == STRIP:
+                url.strip()
+            elif operation == ABSPATH:
+                url.abspath()
+            elif operation == ESCAPE:
+                url.escape(False)
+            elif operation == ESCAPE_STRICT:
+                url.escape(True)
+            elif operation == UNESCAPE:
+                url.unescape()
+            elif operation == CANONICAL:
+                url.sort_query()
+            elif operation == DEFRAG:
+                url.defrag()
+            elif operation == DEPARAM:
+                filter_params(self.blacklists[blacklist], url)
+                blacklist += 1
+            elif operation == DEUSERINFO:
+                url.deuserinfo()
+            elif operation == PUNYCODE:
+                url.punycode()
+            elif operation == UNPUNYCODE:
+                url.unpunycode()
+            elif operation == REMOVE_DEFAULT_PORT:
+                url.remove_default_port()
+            elif operation == SANITIZE:
+                url.abspath().escape(False)
+        return 0
+
+    def apply(self, urls, encoding='utf-8'):
+        '''Return a list of the utf-8 results of applying this pipeline to urls'''
+        cdef vector[string] strings = as_utf8_vector(urls, encoding)
+        cdef vector[string] results
+        cdef Url* url = NULL
+        cdef size_t i
+        results.reserve(strings.size())
+        try:
+            with nogil:
+                for i in range(strings.size()):
+                    url = new Url(strings[i])
+                    self.run(url)
+                    results.push_back(url.str())
+                    del url
+                    url = NULL
+        finally:
+            del url
+        return results
+
+
+cdef class Resolver:
+    '''
+    Resolves many hrefs relative to a single base url, as base.relative(href) would.
+
+    Leading and trailing whitespace is stripped from each href, as browsers do. Hrefs
+    with one of the schemes in skip (by default, javascript:, mailto: and tel:), and
+    hrefs that fail to parse, resolve to None rather than raising. If a pipeline is
+    provided (or a list of steps for one), it's applied to each resolved url.
+    '''
+
+    cdef Url* base
+    cdef Pipeline pipeline
+    cdef bint has_pipeline
+    cdef unordered_set[string] skip
+
+    def __cinit__(self, base, pipeline=None, skip=('javascript', 'mailto', 'tel'),
+                  encoding='utf-8'):
+        cdef string c_base = as_utf8(base, encoding)
+        with nogil:
+            self.base = new Url(c_base)
+        if pipeline is not None and not isinstance(pipeline, Pipeline):
+            pipeline = Pipeline(pipeline)
+        self.pipeline = pipeline
+        self.has_pipeline = pipeline is not None
+        for scheme in skip:
+            self.skip.insert(as_bytes(scheme.lower()))
+
+    def __dealloc__(self):
+        del self.base
+
+    cdef bint skipped(self, const string& href, size_t start) nogil:
+        '''Return true if href has one of the schemes to skip.'''
+        cdef size_t index = href.find(b':', start)
+        cdef string scheme
+        cdef size_t i
+        if index == npos or self.skip.empty():
+            return False
+        for i in range(start, index):
+            if not SCHEME(href[i]):
+                return False
+            scheme.push_back(tolower(href[i]))
+        return self.skip.count(scheme) > 0
+
+    cdef int resolve_one(self, const string& href, string* result) nogil except -1:
+        '''Set result to href resolved against the base, returning 0 if skipped.'''
+        cdef size_t start = 0, end = href.size()
+        while start < end and isspace(href[start]):
+            start += 1
+        while end > start and isspace(href[end - 1]):
+            end -= 1
+        if self.skipped(href, start):
+            return 0
+        cdef Url* url = new Url(href.substr(start, end - start))
+        try:
+            url.relative_to(dereference(self.base)).abspath()
+            if self.has_pipeline:
+                self.pipeline.run(url)
+            result.assign(url.str())
+        finally:
+            del url
+        return 1
+
+    def resolve(self, href, encoding='utf-8'):
+        '''Return href resolved against the base as a utf-8 string, or None.'''
+        return self.resolve_many([href], encoding)[0]
+
+    def resolve_many(self, hrefs, encoding='utf-8'):
+        '''Return a list of each of hrefs resolved against the base, as resolve does.'''
+        cdef vector[string] strings = as_utf8_vector(hrefs, encoding)
+        cdef vector[string] results = vector[string](strings.size())
+        cdef vector[uint8_t] resolved = vector[uint8_t](strings.size())
+        cdef size_t i = 0
+        while i < strings.size():
+            try:
+                with nogil:
+                    while i < strings.size():
+                        resolved[i] = self.resolve_one(strings[i], &results[i])
+                        i += 1
+            except ValueError:
+                # This href is left unresolved, and the rest carry on without the GIL
+                i += 1
+        return [results[i] if resolved[i] else None for i in range(strings.size())]
+
+
+# The components of a URLArray that can be extracted as columns
+cdef dict components = {
+    'scheme': 0, 'userinfo': 1, 'host': 2, 'path': 3, 'params': 4, 'query': 5,
+    'fragment': 6, 'tld': 7, 'pld': 8
+}
+
+cdef class URLArray:
+    '''
+    A compact array of parsed urls, stored in a single buffer as the records that
+    dumps_many uses, so that each component is kept separately.
+
+    Operations like defrag and deparam are applied to every url in place, and
+    components can be extracted as columns, all without parsing the urls again. The
+    utf-8 strings of the urls are exposed through the buffer protocol, with offsets
+    giving where each url starts and ends.
+    '''
+
+    cdef string records
+    cdef vector[size_t] starts
+    # The utf-8 strings of the urls, built on demand and dropped whenever they change
+    cdef string strings
+    cdef vector[size_t] string_starts
+    cdef bint has_strings
+    cdef int exports
+
+    def __cinit__(self, urls=(), encoding='utf-8'):
+        self.starts.push_back(0)
+        self.extend(urls, encoding)
+
+    def __getbuffer__(self, Py_buffer* view, int flags):
+        self.build_strings()
+        PyBuffer_FillInfo(
+            view, self, <void*>self.strings.data(), self.strings.size(), 1, flags)
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer* view):
+        self.exports -= 1
+
+    cdef check_mutable(self):
+        if self.exports:
+            raise BufferError('URLArray cannot be modified while its buffer is exported')
+        # The urls are about to change
+        cdef vector[size_t] string_starts
+        self.strings.clear()
+        self.strings.shrink_to_fit()
+        self.string_starts.swap(string_starts)
+        self.has_strings = False
+
+    cdef build_strings(self):
+        '''Build the utf-8 strings of the urls, if they aren't already.'''
+        if self.has_strings:
+            return
+        cdef string strings
+        cdef vector[size_t] string_starts
+        cdef Url* url = NULL
+        cdef size_t i
+        string_starts.reserve(self.starts.size())
+        string_starts.push_back(0)
+        try:
+            with nogil:
+                for i in range(self.starts.size() - 1):
+                    url = self.load(i)
+                    strings.append(url.str())
+                    string_starts.push_back(strings.size())
+                    del url
+                    url = NULL
+        finally:
+            del url
+        self.strings = move(strings)
+        self.string_starts.swap(string_starts)
+        self.has_strings = True
+
+    cdef Url* load(self, size_t i) nogil except NULL:
+        '''Return a new Url rebuilt from the record of the url at i.'''
+        cdef size_t position = self.starts[i]
+        cdef Url* url = NULL
+        load_url(<const uint8_t*>self.records.data(), self.starts[i + 1], &position, &url)
+        return url
+
+    cdef size_t find_component(self, size_t i, int component, size_t* length) nogil:
+        '''
+        Return where one of the components (0 for scheme to 6 for fragment) of the url
+        at i begins in the records, and set length to its length.
+        '''
+        cdef const uint8_t* data = <const uint8_t*>self.records.data()
+        cdef size_t end = self.starts[i + 1]
+        # Skip the flags and port
+        cdef size_t position = self.starts[i] + 1
+        cdef uint64_t value
+        cdef int j
+        read_varint(data, end, &position, &value)
+        for j in range(component):
+            read_varint(data, end, &position, &value)
+            position += value
+        read_varint(data, end, &position, &value)
+        length[0] = value
+        return position
+
+    def __len__(self):
+        return self.starts.size() - 1
+
+    cdef wrap(self, size_t i):
+        '''Return the url at i as a URL object.'''
+        cdef StringURL result = URL.__new__(URL, unparsed)
+        result.ptr = self.load(i)
+        return result
+
+    def __getitem__(self, index):
+        '''Return the url at index, as a URL object.'''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('URLArray index out of range')
+        return self.wrap(index)
+
+    def __iter__(self):
+        cdef size_t i
+        for i in range(len(self)):
+            yield self.wrap(i)
+
+    def tolist(self):
+        '''Return a list of the utf-8 strings of the urls.'''
+        self.build_strings()
+        cdef size_t i
+        return [
+            PyBytes_FromStringAndSize(
+                self.strings.data() + self.string_starts[i],
+                self.string_starts[i + 1] - self.string_starts[i])
+            for i in range(len(self))]
+
+    property offsets:
+        '''An array of where each url starts in the buffer, followed by its length.'''
+        def __get__(self):
+            self.build_strings()
+            cdef array.array result = array.clone(
+                offset_template, self.string_starts.size(), False)
+            cdef size_t i
+            for i in range(self.string_starts.size()):
+                result.data.as_ulongs[i] = self.string_starts[i]
+            return result
+
+    def extend(self, urls, encoding='utf-8'):
+        '''Parse each of the url strings, and add them to the end of the array.'''
+        self.check_mutable()
+        cdef size_t size = self.records.size(), count = self.starts.size()
+        iterator = iter(urls)
+        try:
+            while self.extend_chunk(
+                    as_utf8_vector(itertools.islice(iterator, 4096), encoding)):
+                pass
+        except:
+            # Leave the array as it was
+            self.records.resize(size)
+            self.starts.resize(count)
+            raise
+
+    cdef bint extend_chunk(self, const vector[string]& strings) except *:
+        '''Parse and append strings, returning false if there were none.'''
+        cdef Url* url = NULL
+        cdef size_t i
+        try:
+            with nogil:
+                for i in range(strings.size()):
+                    url = new Url(strings[i])
+                    dump_url(dereference(url), &self.records)
+                    self.starts.push_back(self.records.size())
+                    del url
+                    url = NULL
+        finally:
+            del url
+        return not strings.empty()
+
+    def apply(self, pipeline):
+        '''Apply a Pipeline (or a list of steps for one) to each url in place.'''
+        self.check_mutable()
+        cdef Pipeline steps = pipeline if isinstance(pipeline, Pipeline) else Pipeline(pipeline)
+        cdef string records
+        cdef vector[size_t] starts
+        cdef Url* url = NULL
+        cdef size_t i
+        records.reserve(self.records.size())
+        starts.reserve(self.starts.size())
+        starts.push_back(0)
+        try:
+            with nogil:
+                for i in range(self.starts.size() - 1):
+                    url = self.load(i)
+                    steps.run(url)
+                    dump_url(dereference(url), &records)
+                    starts.push_back(records.size())
+                    del url
+                    url = NULL
+        finally:
+            del url
+        self.records = move(records)
+        self.starts.swap(starts)
+        return self
+
+    def strip(self):
+        return self.apply(['strip'])
+
+    def abspath(self):
+        return self.apply(['abspath'])
+
+    def escape(self, strict=False):
+        return self.apply([('escape', strict)])
+
+    def unescape(self):
+        return self.apply(['unescape'])
+
+    def canonical(self):
+        return self.apply(['canonical'])
+
+    def defrag(self):
+        return self.apply(['defrag'])
+
+    def deparam(self, params):
+        return self.apply([('deparam', params)])
+
+    def filter_params(self, param_filter):
+        return self.apply([('filter_params', param_filter)])
+
+    def deuserinfo(self):
+        return self.apply(['deuserinfo'])
+
+    def punycode(self):
+        return self.apply(['punycode'])
+
+    def unpunycode(self):
+        return self.apply(['unpunycode'])
+
+    def remove_default_port(self):
+        return self.apply(['remove_default_port'])
+
+    def sanitize(self):
+        return self.apply(['sanitize'])
+
+    def column(self, name, psl=None):
+        '''
+        Return one component of every url as a string of all of them concatenated,
+        and an array of the offsets at which each begins and ends, as pld_many does
+        with packed=True. name is one of scheme, userinfo, host, path, params, query,
+        fragment, tld or pld, which are found with psl, or else the default PSL.
+        '''
+        if name not in components:
+            raise ValueError('Unknown component: %s' % name)
+        cdef int component = components[name]
+        cdef array.array offsets = array.clone(offset_template, self.starts.size(), False)
+        cdef string result, host
+        cdef PSL current = chosen_psl(psl)
+        cdef size_t i, start, length, failed = npos
+        offsets.data.as_ulongs[0] = 0
+        with nogil:
+            for i in range(self.starts.size() - 1):
+                if component < 7:
+                    start = self.find_component(i, component, &length)
+                    result.append(self.records, start, length)
+                else:
+                    start = self.find_component(i, 2, &length)
+                    if length:
+                        host.assign(self.records, start, length)
+                        length = current.tld_length(host) + (component == 8)
+                        if not append_segments(host, length, &result):
+                            failed = i
+                            break
+                offsets.data.as_ulongs[i + 1] = result.size()
+        if failed != npos:
+            raise ValueError('Empty segment in %s' % host.decode('utf-8', 'replace'))
+        return <bytes>result, offsets
+
+    def ports(self):
+        '''Return an array of the port of every url, with 0 where there is none.'''
+        cdef array.array result = array.clone(port_template, self.starts.size() - 1, False)
+        cdef const uint8_t* data = <const uint8_t*>self.records.data()
+        cdef uint64_t port
+        cdef size_t i, position
+        with nogil:
+            for i in range(self.starts.size() - 1):
+                # The port follows the flags
+                position = self.starts[i] + 1
+                read_varint(data, self.starts[i + 1], &position, &port)
+                result.data.as_ints[i] = port
+        return result
+
+cdef array.array port_template = array.array('i')
+
+cdef bint append_segments(const string& hostname, size_t segments, string* result) nogil:
+    '''Append the last segments of hostname to result, or return false if empty.'''
+    cdef string segment
+    if not last_segments(hostname, segments, &segment):
+        return False
+    result.append(segment)
+    return True
+
+###############################################################################
+# Rule sets
+###############################################################################
+
+# A trie of bytes, as a map from (node << 8 | byte) to child node. Node 0 is never a
+# child, so it's returned when there is no such child.
+ctypedef unordered_map[uint64_t, uint32_t] Trie
+
+cdef inline uint32_t trie_child(Trie& trie, uint32_t node, char c) nogil:
+    cdef unordered_map[uint64_t, uint32_t].iterator it = trie.find((<uint64_t>node << 8) | <uint8_t>c)
+    if it == trie.end():
+        return 0
+    return dereference(it).second
+
+cdef uint32_t trie_insert(
+        Trie* trie, uint32_t* size, uint32_t node, const char* s, size_t length):
+    '''Return the node for s under node, adding any nodes (counted by size) missing.'''
+    cdef uint32_t child
+    cdef size_t i
+    for i in range(length):
+        child = trie_child(trie[0], node, s[i])
+        if child == 0:
+            child = size[0]
+            size[0] += 1
+            trie[0][(<uint64_t>node << 8) | <uint8_t>s[i]] = child
+        node = child
+    return node
+
+cdef class RuleSet:
+    '''
+    A set of rules, each matching urls by their host and path, compiled into an index
+    so that matching a url takes about the same time however many rules there are.
+
+    Rules are indexed first by their host condition: an exact host, a host suffix (in
+    a trie of reversed hosts) or a pld. Each of those, and the rules without a host
+    condition, has a trie of the path prefixes of its rules.
+    '''
+
+    # The id of each rule, by the order they were added
+    cdef list ids
+    # The path prefix tries, and the rules ending at each node. Node 0 is the root for
+    # rules without a host condition.
+    cdef Trie paths
+    cdef uint32_t path_nodes
+    cdef vector[vector[uint32_t]] path_rules
+    # Path trie roots for each exact host and pld
+    cdef unordered_map[string, uint32_t] hosts
+    cdef unordered_map[string, uint32_t] plds
+    # Reversed host suffixes, and the path trie root for each suffix's node
+    cdef Trie suffixes
+    cdef uint32_t suffix_nodes
+    cdef unordered_map[uint32_t, uint32_t] suffix_roots
+
+    def __cinit__(self):
+        self.ids = []
+        self.path_nodes = 1
+        self.path_rules.resize(1)
+        self.suffix_nodes = 1
+
+    def __init__(self, rules=()):
+        '''Add each of rules, as (id, {condition: value}) pairs.'''
+        for rule_id, conditions in rules:
+            self.add(rule_id, **conditions)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, rule_id, host=None, host_suffix=None, pld=None, path_prefix=None):
+        '''
+        Add a rule matching urls with all of the given conditions: the host is host,
+        the host is host_suffix or a subdomain of it, the pld is pld, and the path
+        starts with path_prefix. At most one of host, host_suffix and pld may be given.
+        '''
+        if (host is not None) + (host_suffix is not None) + (pld is not None) > 1:
+            raise ValueError('A rule may have only one of host, host_suffix and pld')
+        cdef string c_host
+        cdef string c_path = b'' if path_prefix is None else as_utf8(path_prefix, 'utf-8')
+        cdef uint32_t root = 0
+        cdef uint32_t node
+        if host is not None:
+            root = self.root(&self.hosts, as_utf8(host, 'utf-8').lower())
+        elif pld is not None:
+            root = self.root(&self.plds, as_utf8(pld, 'utf-8').lower())
+        elif host_suffix is not None:
+            c_host = as_utf8(host_suffix, 'utf-8').lower().lstrip(b'.')[::-1]
+            if c_host.empty():
+                raise ValueError('Empty host suffix')
+            node = trie_insert(
+                &self.suffixes, &self.suffix_nodes, 0, c_host.data(), c_host.size())
+            if self.suffix_roots.count(node) == 0:
+                self.suffix_roots[node] = self.new_root()
+            root = self.suffix_roots[node]
+
+        node = trie_insert(
+            &self.paths, &self.path_nodes, root, c_path.data(), c_path.size())
+        self.path_rules.resize(self.path_nodes)
+        self.path_rules[node].push_back(len(self.ids))
+        self.ids.append(rule_id)
+
+    cdef uint32_t new_root(self):
+        self.path_nodes += 1
+        return self.path_nodes - 1
+
+    cdef uint32_t root(self, unordered_map[string, uint32_t]* roots, string key):
+        '''Return the path trie root for key in roots, adding it if it's missing.'''
+        if roots.count(key) == 0:
+            roots[0][key] = self.new_root()
+        return roots[0][key]
+
+    cdef void match_paths(self, uint32_t node, const string& path,
+                          vector[uint32_t]* result) nogil:
+        '''Append the rules under node that path has the prefix of.'''
+        cdef size_t i = 0
+        while True:
+            result.insert(
+                result.end(), self.path_rules[node].begin(), self.path_rules[node].end())
+            if i == path.size():
+                return
+            node = trie_child(self.paths, node, path[i])
+            if node == 0:
+                return
+            i += 1
+
+    cdef void match_one(self, PSL current, const string& host, const string& path,
+                        vector[uint32_t]* result) nogil:
+        '''Set result to the rules matching a url with host and path, in order.'''
+        cdef unordered_map[string, uint32_t].iterator found
+        cdef unordered_map[uint32_t, uint32_t].iterator root
+        cdef string pld
+        cdef uint32_t node = 0
+        cdef size_t i
+        result.clear()
+        self.match_paths(0, path, result)
+        if not host.empty():
+            found = self.hosts.find(host)
+            if found != self.hosts.end():
+                self.match_paths(dereference(found).second, path, result)
+
+            if not self.plds.empty() and last_segments(
+                    host, current.tld_length(host) + 1, &pld) and not pld.empty():
+                found = self.plds.find(pld)
+                if found != self.plds.end():
+                    self.match_paths(dereference(found).second, path, result)
+
+            # Suffixes end at a '.' in the host, or at its start
+            i = host.size()
+            while True:
+                if i == 0 or host[i - 1] == b'.':
+                    root = self.suffix_roots.find(node)
+                    if root != self.suffix_roots.end():
+                        self.match_paths(dereference(root).second, path, result)
+                if i == 0:
+                    break
+                i -= 1
+                node = trie_child(self.suffixes, node, host[i])
+                if node == 0:
+                    break
+        sort(result.begin(), result.end())
+
+    def match(self, url, encoding='utf-8', psl=None):
+        '''
+        Return the ids of the rules matching url (a URL or string), in order, finding
+        plds with psl, or else the default PSL.
+        '''
+        cdef PSL current = chosen_psl(psl)
+        if not isinstance(url, StringURL):
+            url = StringURL.parse(url, encoding)
+        cdef Url* ptr = (<StringURL>url).ptr
+        cdef vector[uint32_t] result
+        with nogil:
+            self.match_one(current, ptr.host(), ptr.path(), &result)
+        return [self.ids[i] for i in result]
+
+    def match_many(self, urls, encoding='utf-8', psl=None):
+        '''
+        Return a list of the ids of the rules matching each of urls (URLs or strings),
+        as match does, with None in place of each string that can't be parsed.
+        '''
+        cdef PSL current = chosen_psl(psl)
+        cdef vector[string] hosts, paths, strings
+        cdef vector[uint8_t] valid
+        cdef Url* parsed
+        for url in urls:
+            if isinstance(url, StringURL):
+                hosts.push_back((<StringURL>url).ptr.host())
+                paths.push_back((<StringURL>url).ptr.path())
+                strings.push_back(string())
+            else:
+                hosts.push_back(string())
+                paths.push_back(string())
+                strings.push_back(as_utf8(url, encoding))
+            valid.push_back(isinstance(url, StringURL))
+
+        cdef vector[vector[uint32_t]] results = vector[vector[uint32_t]](hosts.size())
+        cdef size_t i
+        with nogil:
+            for i in range(hosts.size()):
+                if not valid[i]:
+                    if url_try_parse(strings[i], &parsed) != PARSE_OK:
+                        continue
+                    hosts[i].assign(parsed.host())
+                    paths[i].assign(parsed.path())
+                    del parsed
+                    valid[i] = True
+                self.match_one(current, hosts[i], paths[i], &results[i])
+
+        cdef list ids = self.ids
+        return [
+            [ids[j] for j in results[i]] if valid[i] else None
+            for i in range(hosts.size())]
+
+###############################################################################
+# SURTs
+###############################################################################
+
+cdef size_t www_length(const string& host, PSL current) nogil:
+    '''
+    Return the length of a leading 'www.' (or 'www2.' and so on) in host, or 0 if
+    there is none or it's part of the pld.
+    '''
+    cdef size_t i = 3, segments = 1
+    if host.compare(0, 3, b'www') != 0:
+        return 0
+    while i < host.size() and isdigit(host[i]):
+        i += 1
+    if i >= host.size() or host[i] != b'.':
+        return 0
+    for i in range(i, host.size()):
+        if host[i] == b'.':
+            segments += 1
+    if segments <= current.tld_length(host) + 1:
+        return 0
+    return host.find(b'.') + 1
+
+cdef bint is_address(const string& host) nogil:
+    '''Return true if host is an IPv4 address rather than a hostname.'''
+    for i in range(host.size()):
+        if host[i] != b'.' and not isdigit(host[i]):
+            return False
+    return not host.empty()
+
+cdef int surt(Url* url, PSL current, string* result) nogil except -1:
+    '''
+    Set result to the SURT of url, modifying url along the way. That's the host with
+    its segments reversed and without a leading www (unless it's an IP address), the
+    port if it's not the default, and then the path, params and sorted query, all
+    lowercased.
+    '''
+    url.sort_query().remove_default_port()
+    cdef string host = url.host()
+    cdef size_t start, end, i
+    result.clear()
+    if is_address(host):
+        result.assign(host)
+    else:
+        start = www_length(host, current)
+        end = i = host.size()
+        while i > start:
+            i -= 1
+            if host[i] == b'.':
+                result.append(host, i + 1, end - i - 1)
+                result.push_back(b',')
+                end = i
+        result.append(host, start, end - start)
+    if url.port():
+        result.push_back(b':')
+        result.append(to_string(url.port()))
+    result.push_back(b')')
+    result.append(url.path())
+    if not url.params().empty():
+        result.push_back(b';')
+        result.append(url.params())
+    if not url.query().empty():
+        result.push_back(b'?')
+        result.append(url.query())
+    for i in range(result.size()):
+        result[0][i] = <char>tolower(result[0][i])
+    return 0
+
+def surt_many(urls, packed=False, encoding='utf-8', psl=None):
+    '''
+    Return the SURT of each of the provided url strings, as URL.surt would. If packed,
+    return them concatenated into one string, and an array of offsets where each
+    begins and ends.
+    '''
+    cdef uint64_t started = stats_start()
+    cdef vector[string] strings = as_utf8_vector(urls, encoding)
+    cdef vector[string] results = vector[string](strings.size())
+    cdef PSL current = chosen_psl(psl)
+    cdef Url* url = NULL
+    cdef size_t i
+    try:
+        with nogil:
+            for i in range(strings.size()):
+                url = new Url(strings[i])
+                surt(url, current, &results[i])
+                del url
+                url = NULL
+    finally:
+        del url
+    stats_stop(STATS_SURT_MANY, started)
+    return pack(results, packed)
+
+###############################################################################
+# Seen sets
+###############################################################################
+
+# Seen sets are laid out as follows, with all integers native uint64 so that they can
+# be updated atomically by many processes sharing the mapping:
+#
+#   magic                     SEEN_MAGIC, which also rejects the wrong byte order
+#   capacity                  the most fingerprints that may be added
+#   slots                     the size of the hash table, a power of two
+#   count                     the number of fingerprints added so far
+#   bloom_bits, bloom_hashes  the size of the Bloom filter in bits (a power of two,
+#                             or 0 for none), and the number of bits set per url
+#   reserved[2]
+#   table[slots]              the fingerprint in each slot, or 0 if empty
+#   bloom[bloom_bits / 8]
+#
+# The hash table uses the first half of the 128-bit equiv fingerprint (with 0 taken
+# as 1) and linear probing. The Bloom filter uses double hashing of the second half.
+cdef uint64_t SEEN_MAGIC = 0x0153454553524c55
+cdef size_t SEEN_HEADER_WORDS = 8
+
+cdef extern from *:
+    '''
+    #include <stdint.h>
+
+    static inline uint64_t url_load64(const uint64_t* p)
+    {
+        return __atomic_load_n(p, __ATOMIC_ACQUIRE);
+    }
+
+    static inline int url_cas64(uint64_t* p, uint64_t expected, uint64_t desired)
+    {
+        return __atomic_compare_exchange_n(
+            p, &expected, desired, 0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE);
+    }
+
+    static inline uint64_t url_add64(uint64_t* p, uint64_t value)
+    {
+        return __atomic_fetch_add(p, value, __ATOMIC_ACQ_REL);
+    }
+
+    static inline void url_or8(uint8_t* p, uint8_t value)
+    {
+        __atomic_fetch_or(p, value, __ATOMIC_RELEASE);
+    }
+    '''
+    uint64_t url_load64(const uint64_t* p) nogil
+    bint url_cas64(uint64_t* p, uint64_t expected, uint64_t desired) nogil
+    uint64_t url_add64(uint64_t* p, uint64_t value) nogil
+    void url_or8(uint8_t* p, uint8_t value) nogil
+
+cdef class SeenSet:
+    '''
+    A set of the equiv fingerprints of urls, in a fixed-size hash table that may be
+    memory-mapped from a file, so that it's persistent and can be shared by processes.
+    '''
+
+    cdef object mapping
+    cdef uint8_t[::1] view
+    cdef uint64_t* header
+    cdef uint64_t* table
+    cdef uint64_t mask
+    cdef uint8_t* bloom
+    cdef uint64_t bloom_mask
+    cdef uint64_t bloom_hashes
+
+    def __cinit__(self, path=None, capacity=1000000, bloom_bits=0):
+        '''
+        Open the seen set at path, or create it (or with no path, create it in memory)
+        to hold capacity urls, with an optional Bloom filter of about bloom_bits bits
+        per url in front of it.
+        '''
+        if path is not None and os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'r+b') as fout:
+                self.attach(mmap.mmap(fout.fileno(), 0))
+            return
+
+        if capacity <= 0 or bloom_bits < 0:
+            raise ValueError('Capacity must be positive, and bloom_bits non-negative')
+        cdef uint64_t slots = 1, bits = 0
+        while slots < capacity + capacity // 3 + 1:
+            slots *= 2
+        if bloom_bits:
+            bits = 8
+            while bits < capacity * bloom_bits:
+                bits *= 2
+        cdef size_t size = 8 * (SEEN_HEADER_WORDS + slots) + bits // 8
+        if path is None:
+            mapping = mmap.mmap(-1, size)
+        else:
+            with open(path, 'w+b') as fout:
+                fout.truncate(size)
+                mapping = mmap.mmap(fout.fileno(), size)
+        cdef uint8_t[::1] view = mapping
+        cdef uint64_t* header = <uint64_t*>&view[0]
+        header[1] = capacity
+        header[2] = slots
+        header[4] = bits
+        # The false positive rate is lowest with ln(2) times the bits per url set
+        header[5] = max(1, min(16, <int>(bloom_bits * 0.693 + 0.5))) if bits else 0
+        header[0] = SEEN_MAGIC
+        del view
+        self.attach(mapping)
+
+    cdef attach(self, mapping):
+        '''Use the seen set in mapping, checking that it's intact.'''
+        self.mapping = mapping
+        self.view = mapping
+        cdef size_t size = self.view.shape[0]
+        if size < 8 * SEEN_HEADER_WORDS:
+            self.close()
+            raise ValueError('Not a seen set, or it is truncated.')
+        self.header = <uint64_t*>&self.view[0]
+        cdef uint64_t slots = self.header[2], bits = self.header[4]
+        if (self.header[0] != SEEN_MAGIC
+                or slots == 0 or slots & (slots - 1) or slots <= self.header[1]
+                or bits & (bits - 1) or (bits and bits < 8)
+                or size != 8 * (SEEN_HEADER_WORDS + slots) + bits // 8):
+            self.close()
+            raise ValueError('Not a seen set, or it is truncated or corrupt.')
+        self.table = self.header + SEEN_HEADER_WORDS
+        self.mask = slots - 1
+        self.bloom = <uint8_t*>(self.table + slots)
+        self.bloom_mask = bits - 1
+        self.bloom_hashes = self.header[5] if bits else 0
+
+    def close(self):
+        '''Unmap the seen set. Anything added is already in its file, if it has one.'''
+        self.header = NULL
+        self.view = None
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def flush(self):
+        '''Write any changes to the seen set through to its file.'''
+        self.check_open()
+        self.mapping.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    cdef check_open(self):
+        if self.header == NULL:
+            raise ValueError('Seen set is closed')
+
+    property capacity:
+        '''The most urls this seen set can hold.'''
+        def __get__(self):
+            self.check_open()
+            return self.header[1]
+
+    def __len__(self):
+        self.check_open()
+        return url_load64(self.header + 3)
+
+    cdef bint bloom_contains(self, uint64_t hash) nogil:
+        cdef uint64_t step = (hash >> 32) | 1
+        cdef uint64_t bit, i
+        for i in range(self.bloom_hashes):
+            bit = (hash + i * step) & self.bloom_mask
+            if not self.bloom[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    cdef int insert(self, const uint64_t* halves, bint add) nogil:
+        '''
+        Return 1 if the fingerprint with halves is in the table. Otherwise, return 0,
+        first adding it if add, or return -1 if the table is full.
+        '''
+        cdef uint64_t key = halves[0] if halves[0] else 1
+        cdef uint64_t slot = key & self.mask
+        cdef uint64_t value, bit, i
+        cdef uint64_t step = (halves[1] >> 32) | 1
+        if not add and self.bloom_hashes and not self.bloom_contains(halves[1]):
+            return 0
+        while True:
+            value = url_load64(self.table + slot)
+            if value == key:
+                return 1
+            if value == 0:
+                if not add:
+                    return 0
+                if url_load64(self.header + 3) >= self.header[1]:
+                    return -1
+                if url_cas64(self.table + slot, 0, key):
+                    break
+                # Another process took this slot first, so look at it again
+                continue
+            slot = (slot + 1) & self.mask
+
+        url_add64(self.header + 3, 1)
+        for i in range(self.bloom_hashes):
+            bit = (halves[1] + i * step) & self.bloom_mask
+            url_or8(self.bloom + (bit >> 3), 1 << (bit & 7))
+        return 0
+
+    cdef array.array run(self, urls, encoding, bint add):
+        '''Return an array('B') of whether each url was already present.'''
+        self.check_open()
+        cdef vector[string] strings = as_utf8_vector(urls, encoding)
+        cdef array.array result = array.clone(seen_template, strings.size(), False)
+        cdef uint64_t halves[2]
+        cdef Url* url = NULL
+        cdef size_t i
+        cdef int found = 0
+        try:
+            with nogil:
+                for i in range(strings.size()):
+                    url = new Url(strings[i])
+                    fingerprint(dereference(url), True, halves)
+                    del url
+                    url = NULL
+                    found = self.insert(halves, add)
+                    if found < 0:
+                        break
+                    result.data.as_uchars[i] = found
+        finally:
+            del url
+        if found < 0:
+            raise ValueError('Seen set is full, with %s urls' % self.header[1])
+        return result
+
+    def add(self, url, encoding='utf-8'):
+        '''Add url, returning true if it (or an equivalent url) was already present.'''
+        return self.run((url,), encoding, True)[0] == 1
+
+    def __contains__(self, url):
+        return self.run((url,), 'utf-8', False)[0] == 1
+
+    def add_many(self, urls, encoding='utf-8'):
+        '''
+        Add each of urls, returning an array('B') of whether each was already present.
+        If the seen set fills up, ValueError is raised, and the urls before the one that
+        didn't fit have been added.
+        '''
+        return self.run(urls, encoding, True)
+
+    def contains_many(self, urls, encoding='utf-8'):
+        '''Return an array('B') of whether each of urls is present.'''
+        return self.run(urls, encoding, False)
+
+cdef array.array seen_template = array.array('B')
+
+###############################################################################
+# Stats
+###############################################################################
+
+# Each operation's durations are counted in a histogram with exact buckets below 8ns,
+# and then 8 buckets between each power of two, so that a bucket's midpoint is within
+# 6.25% of each of its durations. Stats are only updated while holding the GIL.
+cdef extern from *:
+    '''
+    #include <chrono>
+
+    static inline uint64_t url_now()
+    {
+        return std::chrono::duration_cast<std::chrono::nanoseconds>(
+            std::chrono::steady_clock::now().time_since_epoch()).count();
+    }
+    '''
+    uint64_t url_now() nogil
+    int url_check_port(const string& url) nogil
+
+cdef enum:
+    STATS_BUCKETS = 496
+
+cdef struct OperationStats:
+    uint64_t calls
+    uint64_t total
+    uint64_t slowest
+    uint64_t buckets[STATS_BUCKETS]
+
+cdef enum StatsOperation:
+    STATS_PARSE
+    STATS_PARSE_MANY
+    STATS_TRY_PARSE
+    STATS_TRY_PARSE_MANY
+    STATS_COPY
+    STATS_EQUIV
+    STATS_FINGERPRINT
+    STATS_HASH
+    STATS_SURT
+    STATS_CANONICAL
+    STATS_DEFRAG
+    STATS_DEPARAM
+    STATS_FILTER_PARAMS
+    STATS_DEUSERINFO
+    STATS_STRIP
+    STATS_ABSPATH
+    STATS_RELATIVE_TO
+    STATS_SANITIZE
+    STATS_REMOVE_DEFAULT_PORT
+    STATS_ESCAPE
+    STATS_UNESCAPE
+    STATS_ENCODE
+    STATS_PUNYCODE
+    STATS_UNPUNYCODE
+    STATS_PLD
+    STATS_TLD
+    STATS_UTF8
+    STATS_UNICODE
+    STATS_PLD_MANY
+    STATS_TLD_MANY
+    STATS_FINGERPRINT_MANY
+    STATS_SURT_MANY
+    STATS_OPERATIONS
+
+# The names of each StatsOperation in snapshots
+cdef tuple stats_names = (
+    'parse', 'parse_many', 'try_parse', 'try_parse_many', 'copy', 'equiv',
+    'fingerprint', 'hash', 'surt', 'canonical', 'defrag', 'deparam', 'filter_params',
+    'deuserinfo', 'strip', 'abspath', 'relative_to', 'sanitize', 'remove_default_port',
+    'escape', 'unescape', 'encode', 'punycode', 'unpunycode', 'pld', 'tld', 'utf8',
+    'unicode', 'pld_many', 'tld_many', 'fingerprint_many', 'surt_many')
+
+# The names of each ParseError other than PARSE_OK in snapshots
+cdef tuple parse_error_names = ('invalid_port', 'port_out_of_range', 'invalid_encoding')
+
+cdef bint stats_enabled = False
+cdef vector[OperationStats] stats_operations = vector[OperationStats](STATS_OPERATIONS)
+cdef uint64_t stats_parse_failures[4]
+cdef uint64_t stats_punycode_errors = 0
+cdef uint64_t stats_psl_lookups = 0
+
+cdef inline uint64_t stats_start() nogil:
+    '''Return when an operation is starting, or 0 if stats are disabled.'''
+    return url_now() if stats_enabled else 0
+
+cdef inline void stats_stop(StatsOperation operation, uint64_t started) nogil:
+    '''Record an operation that began at started, unless stats were disabled then.'''
+    if started:
+        stats_record(operation, url_now() - started)
+
+cdef void stats_record(StatsOperation operation, uint64_t elapsed) nogil:
+    cdef OperationStats* stats = &stats_operations[<int>operation]
+    cdef int shift = 0
+    stats.calls += 1
+    stats.total += elapsed
+    if elapsed > stats.slowest:
+        stats.slowest = elapsed
+    if elapsed < 8:
+        stats.buckets[elapsed] += 1
+        return
+    while (elapsed >> shift) >= 16:
+        shift += 1
+    stats.buckets[(shift + 1) * 8 + <int>((elapsed >> shift) - 8)] += 1
+
+cdef void stats_parse_failed(const string& s, ParseError error) nogil:
+    '''Count a string that couldn't be parsed, finding out why if error is PARSE_OK.'''
+    if not stats_enabled:
+        return
+    if error == PARSE_OK:
+        # Url's constructor only throws for the port, and anything other than a port
+        # that isn't a number is out of range
+        error = <ParseError>url_check_port(s)
+        if error == PARSE_OK:
+            error = PARSE_PORT_OUT_OF_RANGE
+    stats_parse_failures[<int>error] += 1
+
+cdef void stats_punycode_failed() nogil:
+    global stats_punycode_errors
+    if stats_enabled:
+        stats_punycode_errors += 1
+
+cdef void stats_psl_looked_up(size_t count) nogil:
+    global stats_psl_lookups
+    if stats_enabled:
+        stats_psl_lookups += count
+
+cdef double stats_percentile(const OperationStats& stats, double percentile) nogil:
+    '''Return the duration in seconds below which percentile of the calls fell.'''
+    cdef uint64_t rank = <uint64_t>(percentile / 100.0 * stats.calls + 0.5)
+    cdef uint64_t seen = 0
+    cdef double lower, width
+    cdef int bucket
+    if rank < 1:
+        rank = 1
+    for bucket in range(STATS_BUCKETS):
+        seen += stats.buckets[bucket]
+        if seen >= rank:
+            break
+    if bucket < 8:
+        return bucket / 1e9
+    lower = <double>((8 + bucket % 8) << (bucket // 8 - 1))
+    width = <double>(<uint64_t>1 << (bucket // 8 - 1))
+    return min(lower + width / 2, <double>stats.slowest) / 1e9
+
+cdef class Stats:
+    '''
+    Opt-in counters of how often, and for how long, url's operations run: parsing, the
+    methods and computed properties of urls, and the bulk functions. While disabled,
+    each operation only checks a flag. The module's one instance is url.stats.
+    '''
+
+    def enable(self):
+        '''Start recording stats, keeping any recorded before.'''
+        global stats_enabled
+        stats_enabled = True
+
+    def disable(self):
+        '''Stop recording stats, keeping those recorded so far.'''
+        global stats_enabled
+        stats_enabled = False
+
+    def reset(self):
+        '''Forget all recorded stats.'''
+        global stats_punycode_errors, stats_psl_lookups
+        stats_operations.clear()
+        stats_operations.resize(STATS_OPERATIONS)
+        memset(stats_parse_failures, 0, sizeof(stats_parse_failures))
+        stats_punycode_errors = stats_psl_lookups = 0
+
+    property enabled:
+        def __get__(self):
+            return stats_enabled
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        '''
+        Return the recorded stats as a dict. operations holds the calls, total, mean
+        and max duration of each operation that has been called, and the percentiles
+        of its duration as p50 and so on, all in seconds. A bulk function is one call
+        for each batch. parse_failures counts strings that couldn't be parsed by the
+        reason, punycode_errors the hostnames that couldn't be converted, and
+        psl_lookups the hosts looked up by pld, tld, pld_many and tld_many, including
+        those found in the cache.
+        '''
+        cdef dict operations = {}
+        cdef dict operation
+        cdef int i
+        for i in range(STATS_OPERATIONS):
+            if not stats_operations[i].calls:
+                continue
+            operation = {
+                'calls': stats_operations[i].calls,
+                'total': stats_operations[i].total / 1e9,
+                'mean': stats_operations[i].total / 1e9 / stats_operations[i].calls,
+                'max': stats_operations[i].slowest / 1e9,
+            }
+            for percentile in percentiles:
+                operation['p%g' % percentile] = stats_percentile(
+                    stats_operations[i], percentile)
+            operations[stats_names[i]] = operation
+        cdef dict parse_failures = {}
+        for i in range(len(parse_error_names)):
+            parse_failures[parse_error_names[i]] = stats_parse_failures[i + 1]
+        return {
+            'operations': operations,
+            'parse_failures': parse_failures,
+            'punycode_errors': stats_punycode_errors,
+            'psl_lookups': stats_psl_lookups,
+        }
+
+stats = Stats()
+
+# The class parse returns
+URL = UnicodeURL if text_type is str else StringURL